@@ -1,78 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
-import numpy as np
-from .ppp_particle_file import ParticleFile
-from .ppp_result_file import ResultsFile
-from .ppp_grid import HorizontalGrid, VerticalGrid
-from .ppp_quantity import Concentration, Counts
-import warnings
-warnings.filterwarnings("ignore", category=DeprecationWarning)
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
+# Only light modules are imported here: numpy, netCDF4 and the processing
+# modules are imported by the subcommand that needs them, so that help and
+# argument errors are fast
 
 
 def plot(args):
+    # matplotlib is only needed for plotting
+    from .ppp_plot import ParticlePlot, label_name
+    from .ppp_profile import stage
     print("Plotting")
     filename = args.source
-    result_filename = args.out_file
-    raise NotImplementedError("Plotting not implemented yet")
-
-
-def get_state_name_numbers(particle_file):
-    return np.unique(np.abs(particle_file.state))
-
-
-def get_id_name_numbers(particle_file):
-    return sorted(np.unique(particle_file.id))
+    plot_filename = args.out_file
+    particle_plot = ParticlePlot(filename, args.group, args.quantity, args.width, args.height,
+                                 args.dpi, args.cmap, args.log, args.vmin, args.vmax,
+                                 args.window, args.time, args.depth)
+    layers = particle_plot.layers()
+    if (args.layers is not None):
+        layers = [layers[i] for i in args.layers]
+    if (args.labels is not None):
+        labels = [label_name(label) for index, label in layers]
+        layers = [layers[labels.index(label)] for label in args.labels
+                  if label in labels]
+        if (len(layers) == 0):
+            raise Exception(f"No {args.group} layers with labels {args.labels}")
+    with stage("plot"):
+        written = particle_plot.plot(plot_filename, layers, args.workers)
+    print(f"Wrote {len(written)} plot(s): {', '.join(written[:5])}"
+          + (" ..." if len(written) > 5 else ""))
 
 
 def process(args):
-    print("Processing")
-    overwrite = args.overwrite
-    filename = args.source
-    result_filename = args.out_file
-    topo_filename = args.topo
-    resolution = args.resolution
-    id_list = args.id_list
-    # TODO: Default should be a list of all options (loop and compute all)
-    sort_by = args.sort
-    ini_file = args.ini_file
-    last_positions = args.last
-
-    result_file = ResultsFile(result_filename, filename)
-
-    if (result_file.exists and overwrite == False):
-        raise Exception(
-            f"Results file {result_filename} already exists. Use -O to overwrite")
-
-    particle_file = ParticleFile(filename, id_list, ini_file)
-    grid = HorizontalGrid(topo_filename, resolution)
-    result_file.initialize(grid, groups=sort_by)
-
-    # Create name dictionary
-    name_dict = {"state": get_state_name_numbers(particle_file),
-                 "id": get_id_name_numbers(particle_file),
-                 "all": None}
-
-    counts = {sort_type: {
-        "counts": grid.get_counts(particle_file, sort_type),
-        "name_dict": name_dict[sort_type]
-    } for sort_type in sort_by}
-
-    # Compute measures
-    OrdinaryCounter = Counts(grid)
-    ConcentrationCounter = Concentration(grid)
-    for sort_type in sort_by:
-        data = OrdinaryCounter.run(counts[sort_type])
-        result_file.append(data, sort_type)
-
-        data = ConcentrationCounter.run(counts[sort_type])
-        result_file.append(data, sort_type)
-
-    # Save results
-    result_file.write()
-
-    return
+    from .ppp_process import process
+    return process(args)
 
 
 def main():
@@ -85,9 +46,39 @@ def main():
     plot_parser = subparsers.add_parser(
         "plot", help="Plot particle distribution")
     plot_parser.add_argument(
-        "-s", "--source", help="Path to data file", type=str, required=True)
+        "-s", "--source", help="Path to results file", type=str, required=True)
     plot_parser.add_argument(
-        "-o", "--out-file", help="Results file", type=str, required=False, default="counts.nc")
+        "-o", "--out-file", help="Plot file, with several layers the label is added to the name", type=str, required=False, default="plot.png")
+    plot_parser.add_argument(
+        "--group", help="Group of layers to plot", choices=["all", "id", "state", "member"], type=str, required=False, default="all")
+    plot_parser.add_argument(
+        "--quantity", help="Quantity to plot", choices=["concentration", "smoothed_concentration", "counts", "residence_time", "age", "arrival_time"], type=str, required=False, default="concentration")
+    plot_parser.add_argument(
+        "--layers", help="Indices of the layers to plot (default: all layers of the group)", nargs="+", type=int, required=False)
+    plot_parser.add_argument(
+        "--labels", help="Labels (id/state values) of the layers to plot", nargs="+", type=str, required=False)
+    plot_parser.add_argument(
+        "--window", help="Plot only lon0 lon1 lat0 lat1 (lon0 lon1 depth0 depth1 for profiles)", nargs=4, type=float, required=False)
+    plot_parser.add_argument(
+        "--time", help="Time step of a time series (default: last)", type=int, required=False)
+    plot_parser.add_argument(
+        "--depth", help="Depth level of a volume grid", type=int, required=False, default=0)
+    plot_parser.add_argument(
+        "--width", help="Width of the plot (pixels)", type=int, required=False, default=800)
+    plot_parser.add_argument(
+        "--height", help="Height of the plot (pixels)", type=int, required=False, default=600)
+    plot_parser.add_argument(
+        "--dpi", help="Resolution of the plot", type=int, required=False, default=100)
+    plot_parser.add_argument(
+        "--cmap", help="Colormap", type=str, required=False, default="viridis")
+    plot_parser.add_argument(
+        "--log", help="Logarithmic color scale", action='store_true')
+    plot_parser.add_argument(
+        "--vmin", help="Lower limit of the color scale (default: per layer)", type=float, required=False)
+    plot_parser.add_argument(
+        "--vmax", help="Upper limit of the color scale (default: per layer)", type=float, required=False)
+    plot_parser.add_argument(
+        "--workers", help="Number of worker processes rendering layers", type=int, required=False, default=1)
     plot_parser.set_defaults(func=plot)
 
     # Process parser
@@ -96,26 +87,98 @@ def main():
     process_parser.add_argument(
         "-O", "--overwrite", help=f"Overwrite results file", action='store_true')
     process_parser.add_argument(
-        "-s", "--source", help="Path to data file", type=str, required=True)
+        "-s", "--source", help="Path to data file(s) or glob pattern, the counts of all files are summed", nargs="+", type=str, required=True)
     process_parser.add_argument(
         "-o", "--out-file", help="Results file", type=str, required=False, default="counts.nc")
+    process_parser.add_argument(
+        "--dry-run", help="Only check the input files (netCDF headers) and options", action='store_true')
+    process_parser.add_argument(
+        "--update", help="Add the counts of new source files and new time steps to an existing results file", action='store_true')
+    process_parser.add_argument(
+        "--follow", help="Keep updating the results file every FOLLOW seconds while the particle files grow (stop with Ctrl-C)", type=float, required=False)
     process_parser.add_argument(
         "--topo", help="Topography (grid) file", type=str, required=False, default="topo.nc")
     process_parser.add_argument(
         "-dx", "--resolution", help="Resolution of grid (meters)", type=float)
     process_parser.add_argument(
-        "--sort", help="Sort particles", choices=["all", "id", "state"], nargs="*", type=str, required=False, default=["all", "id", "state"])
+        "--grid", help="Grid type: horizontal map, vertical (depth, lon) profile, 3-D volume or native (unstructured/curvilinear) mesh of the topography file", choices=["map", "profile", "volume", "mesh"], type=str, required=False, default="map")
+    process_parser.add_argument(
+        "-dz", "--depth-resolution", help="Vertical resolution of profile/volume grids (meters)", type=float, required=False, default=10.)
+    process_parser.add_argument(
+        "--lat-band", help="Latitude band (degrees) of the transect of a profile grid, only particles within it are counted (default: all latitudes of the topography file). Concentration is per m2 of the section, summed across the band", type=float, nargs=2, required=False)
+    process_parser.add_argument(
+        "--sort", help="Sort particles (member: one layer per source file)", choices=["all", "id", "state", "member"], nargs="*", type=str, required=False, default=["all", "id", "state"])
+    process_parser.add_argument(
+        "--mask-land", help="Do not count positions in land cells (map/volume grids)", action='store_true')
     process_parser.add_argument(
         "--id-list", help="List of particle IDs to use in processing", nargs="+", type=float)
     process_parser.add_argument(
         "--ini-file", help="Initial particle position file", type=str, required=False)
     process_parser.add_argument(
         "--last", help=f"Use only last active position", action='store_true')
+    process_parser.add_argument(
+        "--connectivity", help="Compute the (sparse) connectivity matrix from the release cells (--ini-file) to the cells of all (or last) positions", action='store_true')
+    process_parser.add_argument(
+        "--time-stats", help="Compute the mean residence time, mean particle age and first arrival time of every cell (in the same pass as the counts)", action='store_true')
+    process_parser.add_argument(
+        "--bandwidth", help="Bandwidth (meters) of the Gaussian kernel of the smoothed (kernel density) concentration of map and volume grids (default: twice the cell size, 0: not computed). With --sparse it is only computed for a given bandwidth", type=float, required=False)
+    process_parser.add_argument(
+        "--chunk-size", help="Number of time steps read at once (default: all)", type=int, required=False)
+    process_parser.add_argument(
+        "--workers", help="Number of worker processes", type=int, required=False, default=1)
+    process_parser.add_argument(
+        "--prefetch", help="Number of blocks (--chunk-size time steps) read ahead in a background thread while a block is counted (0: no prefetching)", type=int, required=False, default=0)
+    process_parser.add_argument(
+        "--time-window", help="Write a time series: number of time steps per window, 'daily' or 'monthly'", type=str, required=False)
+    process_parser.add_argument(
+        "--compact", help="Store each quantity as a single compressed variable", action='store_true')
+    process_parser.add_argument(
+        "--float32", help="Keep particle coordinates in single precision (less memory, positions within rounding of a cell edge may be binned differently)", action='store_true')
+    process_parser.add_argument(
+        "--sparse", help="Keep only occupied cells of the counts in memory (high resolution grids, many ids)", action='store_true')
+    process_parser.add_argument(
+        "--sparse-file", help="Store only occupied cells in the results file (implies --sparse)", action='store_true')
+    process_parser.add_argument(
+        "--cache-dir", help="Directory of a cache of counts, grid geometry and mesh cell locators: reruns with the same particle files, grid and options (also with other quantities or additional sort types) reuse the cached counts", type=str, required=False)
+    process_parser.add_argument(
+        "--cache-size", help="Size limit of the cache directory (MB), least recently used counts are removed", type=float, required=False, default=2048.)
+    process_parser.add_argument(
+        "--profile", help="Report time, bytes, positions/s and peak memory of every stage as JSON (to stdout or to a file). Stages of --workers processes are added up. Without a file, progress output goes to stderr", nargs="?", const="-", type=str, required=False)
+    process_parser.add_argument(
+        "--cprofile", help="Write cProfile statistics to a file", type=str, required=False)
     process_parser.set_defaults(func=process)
 
     args = global_parser.parse_args()
-    args.func(args)
 
+    import contextlib
+    import sys
+    import warnings
+    import numpy as np
+    from . import ppp_profile
+    from .ppp_nc_funcs import dataset_pool
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
+    profile = getattr(args, "profile", None)
+    cprofile = getattr(args, "cprofile", None)
+    if (profile is not None):
+        profiler = ppp_profile.enable()
+    if (cprofile is not None):
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    # With the profile report on stdout, progress output goes to stderr
+    output = contextlib.redirect_stdout(
+        sys.stderr) if profile == "-" else contextlib.nullcontext()
+    # Every input file is opened once and closed when the subcommand is done
+    with output, dataset_pool():
+        args.func(args)
+
+    if (cprofile is not None):
+        cprofiler.disable()
+        cprofiler.dump_stats(cprofile)
+    if (profile is not None):
+        profiler.write(None if profile == "-" else profile)
+        ppp_profile.disable()
     return 0
 
 
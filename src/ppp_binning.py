@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def is_regular(edges, rtol=1.e-6):
+    """Check if bin edges are (nearly) equally spaced"""
+    edges = np.asarray(edges)
+    if (len(edges) < 3):
+        return True
+    step = np.diff(edges)
+    return bool(np.all(np.abs(step - step[0]) <= rtol * np.abs(step[0])))
+
+
+# Number of values binned at once, bounds the size of the temporaries
+BLOCK_SIZE = 1 << 20
+# Above this many (group, cell) counts, positions are counted group by group
+MAX_BINCOUNT_SIZE = 1 << 22
+
+
+def bin_index(values, edges):
+    """
+    Find the bin index of every value.
+    Follows np.histogramdd conventions: bins are closed on the left, except
+    for the last bin which is also closed on the right.
+    Values outside the edges (and NaNs) get index -1.
+    Indices are int32, half the memory of the default integer type.
+    """
+    values = np.asarray(values)
+    edges = np.asarray(edges)
+    nbins = len(edges) - 1
+    if (nbins < 1):
+        return np.full(values.shape, -1, dtype=np.int32)
+    if (values.size <= BLOCK_SIZE):
+        return _bin_index(values, edges, is_regular(edges))
+    regular = is_regular(edges)
+    flat = values.ravel()
+    index = np.empty(flat.size, dtype=np.int32)
+    for b0 in range(0, flat.size, BLOCK_SIZE):
+        index[b0:b0+BLOCK_SIZE] = _bin_index(flat[b0:b0+BLOCK_SIZE],
+                                             edges, regular)
+    return index.reshape(values.shape)
+
+
+def _bin_index(values, edges, regular):
+    nbins = len(edges) - 1
+    if (regular):
+        # Direct arithmetic guess, corrected against the actual edges so that
+        # rounding never puts a value in a different bin than searchsorted would
+        step = (edges[-1] - edges[0]) / nbins
+        guess = values - edges[0]
+        if (guess.dtype.kind != "f"):
+            guess = guess.astype(float)
+        # In place, the temporary has the size (and precision) of the values
+        with np.errstate(invalid="ignore"):
+            guess /= step
+            np.floor(guess, out=guess)
+        guess = np.nan_to_num(guess, copy=False, nan=0,
+                              posinf=nbins-1, neginf=0)
+        index = np.clip(guess, 0, nbins-1, out=guess).astype(np.int32)
+        while True:
+            too_high = (values < edges[index]) & (index > 0)
+            if (not too_high.any()):
+                break
+            index[too_high] -= 1
+        while True:
+            too_low = (values >= edges[index+1]) & (index < nbins-1)
+            if (not too_low.any()):
+                break
+            index[too_low] += 1
+    else:
+        index = (np.searchsorted(edges, values, side="right") - 1).astype(np.int32)
+        index[index == nbins] = nbins - 1
+
+    with np.errstate(invalid="ignore"):
+        outside = ~((values >= edges[0]) & (values <= edges[-1]))
+    index[outside] = -1
+    return index
+
+
+def combine_index(indices, shape):
+    """
+    Flat (row-major) cell index from per-dimension bin indices,
+    -1 if the index in any dimension is -1.
+    """
+    # int32 unless the number of cells does not fit
+    dtype = np.int32 if np.prod(shape) < np.iinfo(np.int32).max else np.int64
+    flat = np.zeros(np.shape(indices[0]), dtype=dtype)
+    outside = np.zeros(np.shape(indices[0]), dtype=bool)
+    for index, size in zip(indices, shape):
+        flat *= size
+        flat += index
+        outside |= index < 0
+    flat[outside] = -1
+    return flat
+
+
+def cell_index(x, y, xedges, yedges):
+    """
+    Flat (y, x) cell index of every position, -1 if outside the grid.
+    Cells are numbered row by row: index = iy*(len(xedges)-1) + ix.
+    Positions are processed in blocks, only the result is full size.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    shape = (len(yedges) - 1, len(xedges) - 1)
+    if (x.size <= BLOCK_SIZE):
+        return combine_index([bin_index(y, yedges), bin_index(x, xedges)], shape)
+    xflat = x.ravel()
+    yflat = y.ravel()
+    index = np.empty(x.size, dtype=np.int32 if np.prod(
+        shape) < np.iinfo(np.int32).max else np.int64)
+    for b0 in range(0, x.size, BLOCK_SIZE):
+        b1 = b0 + BLOCK_SIZE
+        index[b0:b1] = combine_index([bin_index(yflat[b0:b1], yedges),
+                                      bin_index(xflat[b0:b1], xedges)], shape)
+    return index.reshape(x.shape)
+
+
+# Largest integer label that is looked up in a table instead of searched
+MAX_TABLE_LABEL = 65535
+
+
+def unique_labels(values):
+    """
+    Sorted unique values. Integers within a small range (e.g. states) are
+    found with a bincount instead of sorting all values.
+    """
+    values = np.ravel(values)
+    if (values.dtype.kind in "iu" and len(values) > 0):
+        vmin = int(values.min())
+        nvalues = int(values.max()) - vmin + 1
+        if (nvalues <= MAX_TABLE_LABEL + 1):
+            # In blocks: bincount converts its input to the default integer type
+            counts = np.zeros(nvalues, dtype=np.int64)
+            for b0 in range(0, len(values), BLOCK_SIZE):
+                counts += np.bincount(values[b0:b0+BLOCK_SIZE].astype(np.int64) - vmin,
+                                      minlength=nvalues)
+            return (np.flatnonzero(counts) + vmin).astype(values.dtype)
+    return np.unique(values)
+
+
+def group_index(values, labels):
+    """
+    Index of every value in the sorted array of labels, -1 if not found.
+    """
+    labels = np.asarray(labels)
+    values = np.asarray(values)
+    if (len(labels) == 0):
+        return np.full(values.shape, -1, dtype=np.intp)
+    if (values.dtype.kind in "iu" and labels.dtype.kind in "iu"
+            and labels[0] >= 0 and labels[-1] <= MAX_TABLE_LABEL):
+        # Lookup table, the last entry is for values that are out of range
+        table = np.full(labels[-1] + 2, -1, dtype=np.int32)
+        table[labels] = np.arange(len(labels))
+        flat = values.ravel()
+        index = np.empty(flat.size, dtype=np.int32)
+        for b0 in range(0, flat.size, BLOCK_SIZE):
+            index[b0:b0+BLOCK_SIZE] = table[np.clip(
+                flat[b0:b0+BLOCK_SIZE], -1, labels[-1] + 1)]
+        return index.reshape(values.shape)
+    index = np.searchsorted(labels, values)
+    index[index == len(labels)] = 0
+    index[labels[index] != values] = -1
+    return index
+
+
+def grouped_counts(cells, ncells, groups=None, ngroups=1, out=None):
+    """
+    Count positions per (group, cell) with np.bincount.
+    cells and groups are index arrays as returned by cell_index and
+    group_index, negative indices are ignored.
+    Returns an integer array of shape (ngroups, ncells), with out (an int64
+    array of that shape) the counts are added to it.
+    """
+    cells = np.ravel(cells)
+    if (groups is not None):
+        groups = np.ravel(groups)
+    size = ngroups * ncells
+    counts = np.zeros((ngroups, ncells), dtype=np.int64) if out is None else out
+    flat_counts = counts.reshape(size)
+    if (groups is not None and size > MAX_BINCOUNT_SIZE):
+        # Group by group, the temporary of bincount is a single group
+        valid = (cells >= 0) & (groups >= 0)
+        group = groups[valid]
+        order = np.argsort(group, kind="stable")
+        bounds = np.searchsorted(group[order], np.arange(ngroups + 1))
+        cells = cells[valid][order]
+        for g in np.flatnonzero(np.diff(bounds)):
+            counts[g] += np.bincount(cells[bounds[g]:bounds[g+1]], minlength=ncells)
+        return counts
+    # In blocks, so that the flat (group, cell) index is never full size;
+    # blocks are at least as large as the counts that they are added to
+    block_size = max(BLOCK_SIZE, size)
+    for b0 in range(0, len(cells), block_size):
+        block = cells[b0:b0+block_size]
+        valid = block >= 0
+        if (groups is not None):
+            group = groups[b0:b0+block_size]
+            valid &= group >= 0
+            flat = group[valid].astype(np.int64)
+            flat *= ncells
+            flat += block[valid]
+        else:
+            flat = block if valid.all() else block[valid]
+        flat_counts += np.bincount(flat, minlength=size)
+    return counts
+
+
+class GroupedCounts:
+    """
+    Accumulator for labelled (group, y, x) counts.
+    Partial counts with different group labels can be added in any order,
+    groups are merged by label.
+    """
+
+    def __init__(self, shape, labels=None):
+        self.shape = tuple(shape)
+        self.labels = None if labels is None else np.asarray(labels)
+        ngroups = 1 if labels is None else len(labels)
+        self.data = np.zeros((ngroups,) + self.shape, dtype=np.int64)
+
+    def _expand(self, labels):
+        """Add new (empty) groups so that all labels are present"""
+        if (len(self.labels) == 0):
+            new_labels = np.unique(labels)
+        else:
+            new_labels = np.union1d(self.labels, labels)
+        if (len(new_labels) == len(self.labels)):
+            return
+        data = np.zeros((len(new_labels),) + self.shape, dtype=np.int64)
+        data[group_index(self.labels, new_labels)] = self.data
+        self.labels = new_labels
+        self.data = data
+
+    def add(self, counts, labels=None):
+        """Add counts of shape (ngroups, *shape) with (sorted) labels"""
+        counts = np.asarray(counts).reshape((-1,) + self.shape)
+        if (self.labels is None):
+            self.data += counts
+            return self
+        self._expand(labels)
+        self.data[group_index(labels, self.labels)] += counts
+        return self
+
+    def count(self, cells, groups=None, labels=None):
+        """
+        Count positions of cell (and group) indices with group labels.
+        The counts are added to the accumulator in place.
+        """
+        ncells = int(np.prod(self.shape))
+        data = self.data.reshape((-1, ncells))
+        if (labels is None or self.labels is None):
+            grouped_counts(cells, ncells, out=data)
+            return self
+        self._expand(labels)
+        data = self.data.reshape((-1, ncells))
+        rows = group_index(labels, self.labels)
+        if (groups is None):
+            # All positions belong to the single group of labels
+            grouped_counts(cells, ncells, out=data[rows[0]:rows[0]+1])
+        else:
+            if (labels is not self.labels):
+                # Group indices of the labels to rows of the accumulator
+                groups = np.where(groups >= 0, rows[np.maximum(groups, 0)], -1)
+            grouped_counts(cells, ncells, groups, len(self.labels), out=data)
+        return self
+
+    def __iadd__(self, other):
+        return self.add(other.data, other.labels)
+
+
+class TimeCounts:
+    """
+    Accumulator for per-cell time statistics of the positions:
+    number of positions, sum of the particle ages, sum of the time steps
+    spent in the cell, number of visits (entries into the cell) and the
+    first arrival time.
+    The cell of every particle at the previous time step and the release
+    time of every particle are kept between blocks, so blocks of one
+    particle file must be counted in time order. start() sets them for a
+    block that does not begin at the first time step.
+    Partial statistics (time slabs, ensemble members) can be added.
+    """
+
+    def __init__(self, shape, nparticles):
+        self.shape = tuple(shape)
+        ncells = int(np.prod(self.shape))
+        self.positions = np.zeros(ncells, dtype=np.int64)
+        self.age = np.zeros(ncells)
+        self.duration = np.zeros(ncells)
+        self.visits = np.zeros(ncells, dtype=np.int64)
+        self.arrival = np.full(ncells, np.inf)
+        self.previous = None
+        self.release = None
+        self.nparticles = nparticles
+
+    @property
+    def started(self):
+        return self.previous is not None
+
+    def start(self, previous=None, release=None):
+        """
+        Cell of every particle before the first block (-1: none) and release
+        time of the particles released before it (NaN: not yet released)
+        """
+        self.previous = np.full(self.nparticles, -1, dtype=np.int64) if previous is None else np.asarray(
+            previous, dtype=np.int64).ravel()
+        self.release = np.full(self.nparticles, np.nan) if release is None else np.array(
+            release, dtype=float)
+        return self
+
+    def count(self, cells, active, times, durations):
+        """
+        Add a (time, particle) block of cell indices (negative: not counted).
+        active marks the positions of released particles (also outside the
+        grid), times and durations are the time (seconds) and the length of
+        every time step of the block.
+        """
+        if (not self.started):
+            self.start()
+        ncells = len(self.positions)
+        # Release time: first active position of a particle
+        new = np.isnan(self.release) & active.any(axis=0)
+        self.release[new] = times[np.argmax(active[:, new], axis=0)]
+        valid = cells >= 0
+        index = cells[valid]
+        rows = np.nonzero(valid)[0]
+        self.positions += np.bincount(index, minlength=ncells)
+        self.age += np.bincount(index, weights=times[rows] - np.broadcast_to(
+            self.release, cells.shape)[valid], minlength=ncells)
+        self.duration += np.bincount(index, weights=durations[rows], minlength=ncells)
+        # A visit starts where a particle is in another cell than one step before
+        entries = valid.copy()
+        entries[0] &= cells[0] != self.previous
+        entries[1:] &= cells[1:] != cells[:-1]
+        self.visits += np.bincount(cells[entries], minlength=ncells)
+        self.previous = cells[-1].astype(np.int64)
+        # First arrival: the earliest entry into every cell not reached in
+        # an earlier block
+        reached = cells[entries]
+        new = np.isinf(self.arrival[reached])
+        np.minimum.at(self.arrival, reached[new], np.broadcast_to(
+            times[:, np.newaxis], cells.shape)[entries][new])
+        return self
+
+    def __iadd__(self, other):
+        self.positions += other.positions
+        self.age += other.age
+        self.duration += other.duration
+        self.visits += other.visits
+        self.arrival = np.fmin(self.arrival, other.arrival)
+        return self
+
+    def mean_age(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.positions > 0, self.age / self.positions, np.nan).reshape(self.shape)
+
+    def residence_time(self):
+        """Mean duration of a visit"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.visits > 0, self.duration / self.visits, np.nan).reshape(self.shape)
+
+    def arrival_time(self):
+        return np.where(np.isinf(self.arrival), np.nan, self.arrival).reshape(self.shape)
+
+
+def sparse_counts(rows, cols, ncols):
+    """
+    Count (row, col) index pairs, pairs with a negative index are ignored.
+    Returns the sorted flat keys row*ncols + col of the nonzero entries and
+    their counts.
+    """
+    rows = np.ravel(rows)
+    cols = np.ravel(cols)
+    valid = (rows >= 0) & (cols >= 0)
+    return np.unique(rows[valid].astype(np.int64) * ncols + cols[valid],
+                     return_counts=True)
+
+
+class SparseCounts:
+    """
+    Accumulator for sparse (row, col) counts.
+    Only the nonzero entries are stored, as sorted flat keys row*ncols + col
+    and their counts.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros(0, dtype=np.int64)
+
+    def add(self, keys, counts):
+        """Add counts of flat keys (as returned by sparse_counts)"""
+        self.keys, inverse = np.unique(np.concatenate((self.keys, keys)),
+                                       return_inverse=True)
+        self.data = np.rint(np.bincount(inverse, weights=np.concatenate(
+            (self.data, counts)), minlength=len(self.keys))).astype(np.int64)
+        return self
+
+    def __iadd__(self, other):
+        return self.add(other.keys, other.data)
+
+    def coo(self):
+        """Entries as (rows, cols, counts) arrays"""
+        rows, cols = np.divmod(self.keys, self.shape[1])
+        return rows, cols, self.data
+
+
+class SparseGroupedCounts(SparseCounts):
+    """
+    Sparse version of GroupedCounts: only the occupied (group, cell) entries
+    are stored, so memory scales with the number of occupied cells instead of
+    groups x grid size.
+    Entries without a value are zero, or the background value of their cell.
+    """
+
+    def __init__(self, shape, labels=None):
+        self.grid_shape = tuple(shape)
+        self.labels = None if labels is None else np.asarray(labels)
+        ngroups = 1 if labels is None else len(labels)
+        super().__init__((ngroups, int(np.prod(self.grid_shape))))
+        self.background = 0
+
+    def _expand(self, labels):
+        """Add new (empty) groups so that all labels are present"""
+        if (len(self.labels) == 0):
+            new_labels = np.unique(labels)
+        else:
+            new_labels = np.union1d(self.labels, labels)
+        if (len(new_labels) == len(self.labels)):
+            return
+        rows, cols = np.divmod(self.keys, self.shape[1])
+        self.keys = group_index(
+            self.labels[rows], new_labels) * self.shape[1] + cols
+        self.labels = new_labels
+        self.shape = (len(new_labels), self.shape[1])
+
+    def add(self, keys, counts, labels=None):
+        """Add counts of flat keys group*ncells + cell with (sorted) group labels"""
+        if (self.labels is not None):
+            self._expand(labels)
+            rows, cols = np.divmod(np.asarray(keys, dtype=np.int64), self.shape[1])
+            keys = group_index(np.asarray(labels)[rows],
+                               self.labels) * self.shape[1] + cols
+        return super().add(keys, counts)
+
+    def count(self, cells, groups=None, labels=None):
+        """Count positions of cell (and group) indices with group labels"""
+        if (groups is None):
+            groups = np.zeros(np.shape(cells), dtype=np.intp)
+        return self.add(*sparse_counts(groups, cells, self.shape[1]), labels)
+
+    def __iadd__(self, other):
+        return self.add(other.keys, other.data, other.labels)
+
+    def with_data(self, data, background=0):
+        """Same entries with other values"""
+        other = SparseGroupedCounts(self.grid_shape, self.labels)
+        other.shape = self.shape
+        other.keys = self.keys
+        other.data = data
+        other.background = background
+        return other
+
+    def layer(self, index):
+        """Dense array of a single group"""
+        start, stop = np.searchsorted(
+            self.keys, [index * self.shape[1], (index + 1) * self.shape[1]])
+        dtype = np.result_type(self.data, np.asarray(self.background))
+        values = np.empty(self.shape[1], dtype=dtype)
+        values[:] = np.ravel(self.background)
+        values[self.keys[start:stop] - index * self.shape[1]] = self.data[start:stop]
+        return values.reshape(self.grid_shape)
+
+    def toarray(self):
+        """Dense (ngroups, *shape) array"""
+        return np.stack([self.layer(i) for i in range(self.shape[0])])
+
+    @classmethod
+    def from_dense(cls, data, labels=None):
+        """Sparse counts of a dense (ngroups, *shape) or (*shape) array"""
+        shape = np.shape(data)[1:] if labels is not None else np.shape(data)
+        counts = cls(shape, labels)
+        flat = np.reshape(data, -1)
+        keys = np.flatnonzero(flat)
+        counts.keys = keys.astype(np.int64)
+        counts.data = np.rint(flat[keys]).astype(np.int64)
+        return counts
+
+
+def merge_counts(shape, *counts):
+    """
+    Sum (counts, labels) pairs as returned by Grid.get_all_counts, groups are
+    merged by label (labels None: a single ungrouped layer).
+    The sum is associative, so partial results can be merged in any order.
+    Returns the summed (counts, labels).
+    """
+    labels = counts[0][1]
+    if (any(isinstance(data, SparseGroupedCounts) for data, labels in counts)):
+        total = SparseGroupedCounts(shape, None if labels is None else [])
+        for data, labels in counts:
+            if (not isinstance(data, SparseGroupedCounts)):
+                data = SparseGroupedCounts.from_dense(data, labels)
+            total += data
+        return total, total.labels
+    total = GroupedCounts(shape, None if labels is None else [])
+    for data, labels in counts:
+        total.add(np.rint(data).astype(np.int64), labels)
+    if (total.labels is None):
+        return total.data[0].astype(float), None
+    return total.data, total.labels
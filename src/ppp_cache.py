@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import numpy as np
+from .ppp_binning import SparseGroupedCounts, TimeCounts
+
+
+def file_key(filename):
+    """Identity of a file for cache invalidation: size and modification time"""
+    stat = os.stat(filename)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def load_arrays(filename, key):
+    """Load arrays saved with save_arrays, None if missing or out of date"""
+    if (not os.path.exists(filename)):
+        return None
+    try:
+        with np.load(filename) as f:
+            if (str(f["key"]) != key):
+                return None
+            return {name: f[name] for name in f.files if name != "key"}
+    except (OSError, ValueError, KeyError):
+        # Broken cache file, it is rewritten
+        return None
+
+
+def save_arrays(filename, key, arrays):
+    """Save arrays with a key, a warning is printed if that fails"""
+    try:
+        np.savez_compressed(filename, key=key, **arrays)
+    except OSError as err:
+        print(f"Warning: could not write cache file {filename}: {err}")
+
+
+def header_hash(filename, nbytes=1 << 16):
+    """Hash of the first bytes of a file (the netCDF/HDF5 header)"""
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read(nbytes)).hexdigest()
+
+
+class CountsCache:
+    """
+    Content addressed cache of counts in a directory, also used for the
+    grid geometry and mesh cell locators.
+    Entries are stored under the hash of their key (a description of the
+    inputs and options they were computed from) and evicted least recently
+    used first when the directory grows over max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=2 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        # The limit may be smaller than in earlier runs
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    def load(self, key):
+        """Arrays stored with key, None if there are none"""
+        filename = self.path(key)
+        arrays = load_arrays(filename, key)
+        if (arrays is not None):
+            # Mark as recently used
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+        return arrays
+
+    def save(self, key, arrays):
+        save_arrays(self.path(key), key, arrays)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if (not name.endswith(".npz")):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if (total <= self.max_size):
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+
+def counts_to_arrays(sort, counts):
+    """Arrays of one sort type of Grid.get_all_counts, for the cache"""
+    data, labels = counts
+    if (sort == "connectivity"):
+        source, destination, values = data
+        return {"source": source, "destination": destination, "values": values}
+    if (sort == "time"):
+        return {"positions": data.positions, "age": data.age, "duration": data.duration,
+                "visits": data.visits, "arrival": data.arrival}
+    # Only the occupied cells are stored
+    if (not isinstance(data, SparseGroupedCounts)):
+        data = SparseGroupedCounts.from_dense(data, labels)
+    arrays = {"keys": data.keys, "data": data.data}
+    if (labels is not None):
+        arrays["labels"] = np.asarray(labels)
+    return arrays
+
+
+def counts_from_arrays(sort, arrays, shape, sparse=False):
+    """Counts of one sort type as returned by Grid.get_all_counts, from cached arrays"""
+    if (sort == "connectivity"):
+        return ((arrays["source"], arrays["destination"], arrays["values"]), None)
+    if (sort == "time"):
+        counts = TimeCounts(shape, 0)
+        for name in ("positions", "age", "duration", "visits", "arrival"):
+            setattr(counts, name, arrays[name])
+        return (counts, None)
+    labels = arrays.get("labels")
+    counts = SparseGroupedCounts(shape, labels)
+    counts.keys = arrays["keys"]
+    counts.data = arrays["data"]
+    if (sparse):
+        return (counts, counts.labels)
+    dense = np.zeros(int(np.prod(counts.shape)), dtype=np.int64)
+    dense[counts.keys] = counts.data
+    if (labels is None):
+        return (dense.reshape(shape).astype(float), None)
+    return (dense.reshape((len(labels),) + tuple(shape)), counts.labels)
@@ -1,22 +1,83 @@
 #!/usr/bin/env python3
 
-from .ppp_nc_funcs import get_var, get_dimensions
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .ppp_nc_funcs import get_var, get_dimensions, get_variables
+from .ppp_locator import CellLocator
+import os
+from .ppp_cache import file_key
+from . import ppp_profile
+from .ppp_profile import stage, record
+from .ppp_binning import bin_index, cell_index, combine_index, group_index, unique_labels, GroupedCounts, sparse_counts, SparseCounts, SparseGroupedCounts, TimeCounts
+from .ppp_particle_file import ParticleChunk, PrefetchStats, take_prefetch_stats
 import numpy as np
 
 
+def _add_counts(totals, partial):
+    """Add partial counts of every sort type to the totals (None at first)"""
+    if (totals is None):
+        return partial
+    for sort, counts in partial.items():
+        totals[sort] += counts
+    return totals
+
+
+def worker_pool(workers):
+    """
+    Process pool of the counting workers, to be shared by all time windows
+    and files of a run. A context manager, None without workers (<= 1).
+    """
+    if (workers is None or workers <= 1):
+        return contextlib.nullcontext()
+    # Spawn fresh interpreters: netCDF/HDF5 state must not be shared by fork
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+def _count_task(count, profile, *args):
+    """
+    Counts of a worker process task, the prefetch statistics of the task and,
+    with profile, its stage statistics (None otherwise)
+    """
+    take_prefetch_stats()
+    if (not profile):
+        return count(*args), take_prefetch_stats(), None
+    profiler = ppp_profile.enable()
+    try:
+        counts = count(*args)
+    finally:
+        ppp_profile.disable()
+    return counts, take_prefetch_stats(), profiler.stages
+
+
 class Grid:
     """Base class for grid data"""
 
     m2deg = 1./(1852.*60.)
     deg2m = 1852.*60.
 
-    def __init__(self, filename):
+    # Particle variables needed for binning
+    variables = ("lon", "lat", "state")
+
+    _count_messages = {"all": "Calculating counts...",
+                       "id": "Calculating counts by id...",
+                       "state": "Calculating counts by state...",
+                       "member": "Calculating counts by ensemble member...",
+                       "connectivity": "Calculating connectivity...",
+                       "time": "Calculating residence time and particle age..."}
+
+    def __init__(self, filename, read=True):
         self.filename = filename
         self.lon = None
         self.lat = None
         self.depth = None
+        self.depth_edges = None
         self.type = None
-        self.read_file()
+        # Cells of the release positions (connectivity sources) per particle file
+        self._source_cells = {}
+        if (read):
+            self.read_file()
         return
 
     @property
@@ -33,6 +94,238 @@ class Grid:
     def set_resolution(self, resolution):
         pass
 
+    @property
+    def shape(self):
+        return tuple(self.dims.values())
+
+    @property
+    def cell_size(self):
+        """Area (or volume) of every cell, used for concentrations"""
+        return self.cell_area
+
+    @property
+    def aux_coords(self):
+        """Additional coordinate variables: name -> (dimensions, values)"""
+        return {}
+
+    def cell_index(self, chunk):
+        """Flat cell index of every position in a block of particle data"""
+        raise NotImplementedError("Grid.cell_index not implemented")
+
+    def set_depth_resolution(self, depth_resolution):
+        """Depth bins from the surface to the deepest point of the bathymetry"""
+        self.depth_edges = np.arange(
+            0., np.nanmax(self.depth) + depth_resolution, depth_resolution)
+
+    def bathymetry_at(self, lon, lat):
+        """Bathymetry of the nearest topography grid node"""
+        ix = _nearest_index(self.topo_lon, lon)
+        iy = _nearest_index(self.topo_lat, lat)
+        return self.depth[iy, ix]
+
+    def new_counter(self, particle_file, sort, sparse=False):
+        """
+        Create an empty counts accumulator for a sort type, with sparse only
+        the occupied cells are stored
+        """
+        shape = self.shape
+        counter = SparseGroupedCounts if sparse else GroupedCounts
+        if (sort == "all"):
+            return counter(shape)
+        elif (sort == "id"):
+            return counter(shape, np.unique(particle_file.id))
+        elif (sort in ("state", "member")):
+            # States are only known after reading, groups are added on the fly
+            return counter(shape, [])
+        elif (sort == "connectivity"):
+            ncells = int(np.prod(shape))
+            return SparseCounts((ncells, ncells))
+        elif (sort == "time"):
+            return TimeCounts(shape, particle_file.nparticles)
+        raise ValueError(f"Unknown sort type: {sort}")
+
+    def count_chunk(self, chunk, totals):
+        """
+        Add counts of a block of particle data to the accumulators.
+        The cell of every position is found once and shared by all sort types.
+        """
+        with stage("bin"):
+            cells = self.cell_index(chunk)
+            # Positions outside the grid (and NaNs) are dropped once for all sort types
+            shape = cells.shape
+            valid = cells >= 0
+            block_cells = cells
+            cells = cells[valid]
+        record("bin", positions=valid.size)
+        ncells = int(np.prod(self.shape))
+        for sort, total in totals.items():
+            with stage(f"count_{sort}"):
+                if (sort == "all"):
+                    total.count(cells)
+                elif (sort == "id"):
+                    # Group of every particle, broadcast along time without a copy
+                    ids = total.labels
+                    groups = group_index(chunk.id, ids).astype(np.int32)
+                    total.count(cells, np.broadcast_to(
+                        groups, shape)[valid], ids)
+                elif (sort == "state"):
+                    # Layers are labelled by the absolute state, but only positions
+                    # with exactly that state value are counted in them
+                    states = np.unique(np.abs(unique_labels(chunk.state)))
+                    total.count(cells, group_index(
+                        chunk.state[valid], states), states)
+                elif (sort == "member"):
+                    total.count(cells, None, [chunk.particle_file.member])
+                elif (sort == "connectivity"):
+                    # Source is the cell of the release position of every particle
+                    sources = self.source_cells(chunk.particle_file)
+                    total.add(*sparse_counts(np.broadcast_to(sources,
+                                                             shape)[valid], cells, ncells))
+                elif (sort == "time"):
+                    if (chunk.last_index is not None):
+                        raise Exception("Residence time and age need all positions, not only the last")
+                    if (not total.started):
+                        self.start_time_counts(total, chunk)
+                    pfile = chunk.particle_file
+                    steps = slice(chunk.start, chunk.stop)
+                    total.count(block_cells, ~np.isnan(chunk.lon),
+                                pfile.elapsed[steps], pfile.durations[steps])
+        return totals
+
+    @classmethod
+    def particle_variables(cls, sorts):
+        """Particle variables that are read to count the sort types"""
+        return tuple(vname for vname in cls.variables
+                     if vname != "state" or "state" in sorts)
+
+    def source_cells(self, particle_file):
+        """
+        Cell of the release position of every particle, found once per
+        particle file (only the position variables of the grid are read)
+        """
+        if (particle_file not in self._source_cells):
+            self._source_cells[particle_file] = self.cell_index(
+                particle_file.initial_positions(self.variables))
+        return self._source_cells[particle_file]
+
+    def start_time_counts(self, total, chunk):
+        """
+        Cells and release times of the particles before a block that does not
+        start at the first time step (a time slab, window or update)
+        """
+        if (chunk.start == 0):
+            total.start()
+            return
+        pfile = chunk.particle_file
+        previous = ParticleChunk(pfile, chunk.start - 1, chunk.start)
+        total.start(self.cell_index(previous)[0], pfile.release_times(chunk.start))
+
+    def count_slab(self, particle_file, sorts, start=0, stop=None, chunk_size=None, sparse=False, prefetch=0):
+        """
+        Count all sort types over time steps start...stop of the particle file.
+        With prefetch > 0, that many blocks are read ahead in a background thread.
+        """
+        totals = {sort: self.new_counter(particle_file, sort, sparse)
+                  for sort in sorts}
+        for chunk in particle_file.iter_chunks(chunk_size, start, stop,
+                                               self.particle_variables(sorts), prefetch):
+            self.count_chunk(chunk, totals)
+        return totals
+
+    def count_file(self, particle_file, sorts, start=0, stop=None, chunk_size=None, last=False, sparse=False, prefetch=0):
+        """
+        Count all sort types over time steps start...stop of the particle file,
+        only the last active position of every particle with last
+        """
+        if (not last):
+            return self.count_slab(particle_file, sorts, start, stop, chunk_size, sparse, prefetch)
+        totals = {sort: self.new_counter(particle_file, sort, sparse)
+                  for sort in sorts}
+        self.count_chunk(particle_file.last_positions(
+            chunk_size, start, stop, self.particle_variables(sorts)), totals)
+        return totals
+
+    def get_all_counts(self, particle_file, sorts, chunk_size=None, workers=1, start=0, stop=None, last=False, sparse=False, prefetch=0, pool=None):
+        """
+        Count particle positions on the grid for every sort type in one pass.
+        The particle file is read in blocks of chunk_size time steps and the
+        partial counts are accumulated, so only one block is in memory at a time.
+        With workers > 1 the time axis is split into slabs that are counted in
+        a process pool, each worker reading the file on its own. The pool
+        (see worker_pool) can be given so that it is reused between calls.
+        particle_file can also be a list of particle files (ensemble members),
+        their counts are summed. With workers > 1 every file is counted by
+        one worker.
+        Only time steps start...stop are counted. With last, only the last
+        active position of every particle within that range is counted.
+        Returns a dictionary of (counts, group labels) per sort type,
+        labels are None for "all". Connectivity counts are returned as
+        (source cell, destination cell, count) arrays, time statistics
+        (sort type "time") as TimeCounts.
+        With sparse, counts are accumulated and returned as SparseGroupedCounts.
+        With prefetch > 0, every counting process reads the next prefetch
+        blocks while a block is counted, the share of the read time hidden
+        behind the counting is reported.
+        """
+        for sort in sorts:
+            print(self._count_messages[sort])
+        take_prefetch_stats()
+        prefetch_stats = PrefetchStats()
+
+        particle_files = particle_file if isinstance(
+            particle_file, (list, tuple)) else [particle_file]
+        # The first partial counts are the totals, later ones are added in place
+        totals = None
+        if (workers is None or workers <= 1):
+            for pfile in particle_files:
+                partial = self.count_file(
+                    pfile, sorts, start, stop, chunk_size, last, sparse, prefetch)
+                totals = _add_counts(totals, partial)
+            prefetch_stats += take_prefetch_stats()
+        else:
+            if (len(particle_files) > 1 or last):
+                # One task per file, every file is read once
+                tasks = [(self.count_file, pfile, sorts, start, stop, chunk_size, last, sparse, prefetch)
+                         for pfile in particle_files]
+            else:
+                if (stop is None):
+                    stop = particle_files[0].ntime
+                nslabs = max(min(stop - start, 4*workers), 1)
+                bounds = np.linspace(start, stop, nslabs+1).astype(int)
+                tasks = [(self.count_slab, particle_files[0], sorts, t0, t1, chunk_size, sparse, prefetch)
+                         for t0, t1 in zip(bounds[:-1], bounds[1:])]
+            with (worker_pool(workers) if pool is None else contextlib.nullcontext(pool)) as pool:
+                # Workers profile their stages if this process does
+                profile = ppp_profile.profiler() is not None
+                futures = [pool.submit(_count_task, task[0], profile, *task[1:])
+                           for task in tasks]
+                for future in futures:
+                    partial, stats, stages = future.result()
+                    totals = _add_counts(totals, partial)
+                    prefetch_stats += stats
+                    if (stages is not None):
+                        ppp_profile.merge(stages)
+        if (prefetch_stats.chunks > 0):
+            print(prefetch_stats.summary())
+
+        counts = {}
+        for sort, total in totals.items():
+            if (sort == "time"):
+                counts[sort] = (total, None)
+            elif (sparse and sort != "connectivity"):
+                counts[sort] = (total, total.labels)
+            elif (sort == "all"):
+                counts[sort] = (total.data[0].astype(float), None)
+            elif (sort == "connectivity"):
+                counts[sort] = (total.coo(), None)
+            else:
+                counts[sort] = (total.data, total.labels)
+        return counts
+
+    def get_counts(self, particle_file, sort, chunk_size=None, workers=1):
+        """Count particle positions on the grid for a single sort type"""
+        return self.get_all_counts(particle_file, [sort], chunk_size, workers)[sort]
+
     def read_file(self):
         dims = get_dimensions(self.filename)
         # Check that the file has "lon" and "lat" dimensions
@@ -46,76 +339,65 @@ class Grid:
         self.lon = get_var(self.filename, lon_name)
         self.lat = get_var(self.filename, lat_name)
         self.depth = get_var(self.filename, depth_name)
-
-    def counts(self, positions, binx, biny):
-        print("Calculating counts...")
-        bins = np.array([binx, biny])
-        c, _ = np.histogramdd(positions, bins=bins)
-        return c.T
-
-    def counts_by_state(self, positions, state, binx, biny):
-        print("Calculating counts by state...")
-        state = state.flatten()
-        states = sorted(list(set(np.abs(state))))
-        nstates = len(states)
-
-        nx = len(binx)
-        ny = len(biny)
-        bins = np.array([binx, biny])
-
-        nanmask = np.isnan(positions)
-        nanmask = nanmask[:, 0] + nanmask[:, 1]
-        positions = positions[~nanmask]
-        state = state[~nanmask]
-
-        counts = np.zeros((nstates, ny-1, nx-1), dtype=int)
-        for istate in range(nstates):
-            kkstate = np.squeeze(np.where(state == states[istate]))
-            c, _ = np.histogramdd(positions[kkstate], bins)
-            counts[istate, :, :] = c.T
-        return counts
-
-    def counts_by_id(self, positions, id, binx, biny):
-        print("Calculating counts by id...")
-        id = id.flatten()
-        ids = sorted(list(set(id)))
-        nids = len(ids)
-
-        nx = len(binx)
-        ny = len(biny)
-        bins = np.array([binx, biny])
-
-        nanmask = np.isnan(positions)
-        nanmask = nanmask[:, 0] + nanmask[:, 1]
-        positions = positions[~nanmask]
-        id = id[~nanmask]
-
-        counts = np.zeros((nids, ny-1, nx-1), dtype=int)
-        for iid in range(nids):
-            kkid = np.squeeze(np.where(id == ids[iid]))
-            c, _ = np.histogramdd(positions[kkid], bins)
-            counts[iid, :, :] = c.T
-        return counts
+        # Topography node coordinates (lon/lat may be replaced by bin edges)
+        self.topo_lon = self.lon
+        self.topo_lat = self.lat
 
 
 class HorizontalGrid(Grid):
-    """Class to store horizontal grid data (maps)"""
-
-    def __init__(self, filename, resolution=None):
+    """
+    Class to store horizontal grid data (maps).
+    With a cache (the counts cache of --cache-dir), the grid geometry (bin
+    edges, cell areas, land mask) is stored and reused while the topography
+    file and resolution are unchanged, the topography is then not read.
+    """
+
+    # Arrays stored in the geometry cache
+    geometry_fields = ("lon", "lat", "dlon", "dlat", "dx", "dy",
+                       "cell_area", "cell_bathymetry", "land")
+
+    def __init__(self, filename, resolution=None, mask_land=False, cache=None):
         self.filename = filename
-        super().__init__(filename)
+        super().__init__(filename, read=False)
         self.type = "map"
         self.dlon = None
         self.dlat = None
         self.dx = None
         self.dy = None
         self.cell_area = None
+        self.cell_bathymetry = None
+        self.land = None
         self.resolution = resolution
-        if (resolution is not None):
-            self.set_resolution(resolution)
-        self.create_mesh()
+        self.mask_land = mask_land
+        self.cache = cache
+        if (not self.load_geometry()):
+            self.read_file()
+            if (resolution is not None):
+                self.set_resolution(resolution)
+            self.create_mesh()
+            self.save_geometry()
         return
 
+    def geometry_key(self):
+        return (f"{type(self).__name__}-{os.path.abspath(self.filename)}-"
+                f"{file_key(self.filename)}-{self.resolution}")
+
+    def load_geometry(self):
+        """Load cached grid geometry, returns False if there is none"""
+        if (self.cache is None):
+            return False
+        arrays = self.cache.load(self.geometry_key())
+        if (arrays is None or not set(self.geometry_fields).issubset(arrays)):
+            return False
+        for name in self.geometry_fields:
+            setattr(self, name, arrays[name])
+        return True
+
+    def save_geometry(self):
+        if (self.cache is not None):
+            self.cache.save(self.geometry_key(),
+                            {name: getattr(self, name) for name in self.geometry_fields})
+
     @property
     def coords(self):
         # ! np.histogramdd reduces size of each dimension by 1
@@ -127,14 +409,22 @@ class HorizontalGrid(Grid):
         return {"lat": len(self.lat)-1, "lon": len(self.lon)-1}
 
     def create_mesh(self):
-        """Create meshgrid in meters"""
+        """Create meshgrid in meters, cell areas and land mask"""
         self.dlon = np.diff(self.lon)
         self.dlat = np.diff(self.lat)
         dlon_m, dlat_m = np.meshgrid(self.dlon, self.dlat)
+        # Zonal cell size at the center latitude of every row
+        lat_c = 0.5*(self.lat[1:] + self.lat[:-1])
         self.dx = dlon_m * self.deg2m * \
-            np.cos(np.nanmean(self.lat) * np.pi/180.)
+            np.cos(lat_c * np.pi/180.)[:, np.newaxis]
         self.dy = dlat_m * self.deg2m
         self.cell_area = self.dx * self.dy
+        # Bathymetry of the nearest topography node at cell centers
+        lon_m, lat_m = np.meshgrid(
+            0.5*(self.lon[1:] + self.lon[:-1]), lat_c)
+        self.cell_bathymetry = self.bathymetry_at(lon_m, lat_m)
+        with np.errstate(invalid="ignore"):
+            self.land = ~(self.cell_bathymetry > 0.)
 
     def set_resolution(self, resolution):
         dlon_bin = resolution*self.m2deg / \
@@ -145,28 +435,234 @@ class HorizontalGrid(Grid):
         self.lat = np.arange(
             np.nanmin(self.lat), np.nanmax(self.lat) + dlat_bin, dlat_bin)
 
-    def get_counts(self, particle_file, sort):
-        if (sort == "all"):
-            return self.counts(particle_file.positions())
-        elif (sort == "id"):
-            return self.counts_by_id(particle_file.positions(),
-                                     np.tile(particle_file.id, (particle_file.ntime, 1)))
-        elif (sort == "state"):
-            return self.counts_by_state(particle_file.positions(), particle_file.state)
-
-    def counts(self, positions):
-        return super().counts(positions, self.lon, self.lat)
-
-    def counts_by_state(self, positions, state):
-        return super().counts_by_state(positions, state, self.lon, self.lat)
+    def cell_index(self, chunk):
+        index = cell_index(chunk.lon, chunk.lat, self.lon, self.lat)
+        if (self.mask_land):
+            index = self.drop_land(index)
+        return index
 
-    def counts_by_id(self, positions, id):
-        return super().counts_by_id(positions, id, self.lon, self.lat)
+    def drop_land(self, index):
+        """Drop positions in land cells (index set to -1)"""
+        land = np.broadcast_to(self.land, self.shape).ravel()
+        index[(index >= 0) & land[index]] = -1
+        return index
 
     def landmask(self):
-        pass
+        """Land (True) / sea mask of the grid cells"""
+        return self.land
 
 
 class VerticalGrid(Grid):
-    """Class to store vertical grid data (profiles)"""
-    pass
+    """
+    Class to store vertical grid data (profiles).
+    Particles are binned by depth and longitude within a latitude band
+    (lat_band, by default the whole latitude range of the topography grid),
+    a zonal transect. The concentration is per m2 of the (depth, lon)
+    section: particles are summed across the band, not divided by its width.
+    """
+
+    variables = ("lon", "lat", "depth", "state")
+
+    def __init__(self, filename, resolution=None, depth_resolution=10., lat_band=None):
+        self.filename = filename
+        super().__init__(filename)
+        self.type = "profile"
+        if (lat_band is None):
+            lat_band = (np.nanmin(self.lat), np.nanmax(self.lat))
+        self.lat_band = (float(min(lat_band)), float(max(lat_band)))
+        self.dlon = None
+        self.dx = None
+        self.dz = None
+        self.cell_area = None
+        self.resolution = resolution
+        self.depth_resolution = depth_resolution
+        if (resolution is not None):
+            self.set_resolution(resolution)
+        self.set_depth_resolution(depth_resolution)
+        self.create_mesh()
+        return
+
+    @property
+    def coords(self):
+        return {"depth": self.depth_edges[:-1], "lon": self.lon[:-1]}
+
+    @property
+    def dims(self):
+        return {"depth": len(self.depth_edges)-1, "lon": len(self.lon)-1}
+
+    def create_mesh(self):
+        """Create (depth, lon) section mesh in meters"""
+        self.dlon = np.diff(self.lon)
+        dlon_m, self.dz = np.meshgrid(self.dlon, np.diff(self.depth_edges))
+        self.dx = dlon_m * self.deg2m * \
+            np.cos(np.mean(self.lat_band) * np.pi/180.)
+        self.cell_area = self.dx * self.dz
+
+    def set_resolution(self, resolution):
+        dlon_bin = resolution*self.m2deg / \
+            np.cos(np.mean(self.lat_band) * np.pi/180.)
+        self.lon = np.arange(
+            np.nanmin(self.lon), np.nanmax(self.lon) + dlon_bin, dlon_bin)
+
+    def cell_index(self, chunk):
+        iz = bin_index(chunk.depth, self.depth_edges)
+        ix = bin_index(chunk.lon, self.lon)
+        index = combine_index([iz, ix], self.shape)
+        # Positions outside the latitude band of the transect are not counted
+        with np.errstate(invalid="ignore"):
+            index[~((chunk.lat >= self.lat_band[0]) &
+                    (chunk.lat <= self.lat_band[1]))] = -1
+        return index
+
+
+class VolumeGrid(HorizontalGrid):
+    """
+    Class to store 3-D grid data (depth, lat, lon).
+    Cell volumes are limited by the bathymetry, cells below the sea floor
+    have zero volume.
+    """
+
+    variables = ("lon", "lat", "depth", "state")
+    geometry_fields = HorizontalGrid.geometry_fields + \
+        ("depth_edges", "cell_volume")
+
+    def __init__(self, filename, resolution=None, depth_resolution=10., mask_land=False, cache=None):
+        self.depth_resolution = depth_resolution
+        self.cell_volume = None
+        super().__init__(filename, resolution, mask_land, cache)
+        self.type = "volume"
+        return
+
+    def geometry_key(self):
+        return f"{super().geometry_key()}-{self.depth_resolution}"
+
+    @property
+    def coords(self):
+        return {"depth": self.depth_edges[:-1], "lat": self.lat[:-1], "lon": self.lon[:-1]}
+
+    @property
+    def dims(self):
+        return {"depth": len(self.depth_edges)-1, "lat": len(self.lat)-1, "lon": len(self.lon)-1}
+
+    @property
+    def cell_size(self):
+        return self.cell_volume
+
+    def create_mesh(self):
+        """Create mesh in meters and cell volumes (computed once)"""
+        super().create_mesh()
+        self.set_depth_resolution(self.depth_resolution)
+        # Water column thickness within every depth bin
+        top = self.depth_edges[:-1, np.newaxis, np.newaxis]
+        dz = np.diff(self.depth_edges)[:, np.newaxis, np.newaxis]
+        thickness = np.clip(
+            self.cell_bathymetry[np.newaxis, :, :] - top, 0., dz)
+        self.cell_volume = thickness * self.cell_area[np.newaxis, :, :]
+
+    def cell_index(self, chunk):
+        iz = bin_index(chunk.depth, self.depth_edges)
+        iy = bin_index(chunk.lat, self.lat)
+        ix = bin_index(chunk.lon, self.lon)
+        index = combine_index([iz, iy, ix], self.shape)
+        if (self.mask_land):
+            index = self.drop_land(index)
+        return index
+
+
+class UnstructuredGrid(Grid):
+    """
+    Class to store unstructured (triangular mesh) or curvilinear grid data.
+    Particles are counted on the native cells of the model mesh: the
+    elements of a triangular mesh (FVCOM-style "nv" connectivity), or the
+    quadrilaterals between the nodes of a curvilinear grid (2-D lon/lat).
+    Positions are located with a CellLocator, with a cache (--cache-dir) it
+    is stored and reused in later runs.
+    """
+
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        self.triangles = None
+        self.tri_cell = None
+        self.ncells = None
+        super().__init__(filename)
+        self.type = "mesh"
+        self.cell_area = None
+        self.lonc = None
+        self.latc = None
+        self.create_mesh()
+        self.locator = CellLocator.cached(
+            cache, filename, self.lon, self.lat, self.triangles, self.tri_cell)
+        return
+
+    @property
+    def coords(self):
+        return {"cell": np.arange(self.ncells)}
+
+    @property
+    def dims(self):
+        return {"cell": self.ncells}
+
+    @property
+    def aux_coords(self):
+        return {"lonc": (("cell",), self.lonc), "latc": (("cell",), self.latc)}
+
+    def read_file(self):
+        variables = get_variables(self.filename)
+        lon_name = [name for name in ["lon", "longitude"] if name in variables][0]
+        lat_name = [name for name in ["lat", "latitude"] if name in variables][0]
+        self.lon = get_var(self.filename, lon_name)
+        self.lat = get_var(self.filename, lat_name)
+        for depth_name in ["bathymetry", "h"]:
+            if (depth_name in variables):
+                self.depth = get_var(self.filename, depth_name)
+                break
+        if ("nv" in variables):
+            # FVCOM connectivity: (3, nele), 1-based node numbers
+            self.triangles = get_var(self.filename, "nv").T.astype(np.intp) - 1
+            self.tri_cell = np.arange(len(self.triangles))
+            self.ncells = len(self.triangles)
+        elif (self.lon.ndim == 2):
+            # Curvilinear grid: every quad is split into two triangles
+            ny, nx = self.lon.shape
+            node = np.arange(ny*nx).reshape((ny, nx))
+            sw = node[:-1, :-1].ravel()
+            se = node[:-1, 1:].ravel()
+            nw = node[1:, :-1].ravel()
+            ne = node[1:, 1:].ravel()
+            self.triangles = np.concatenate(
+                [np.stack([sw, se, ne], axis=1), np.stack([sw, ne, nw], axis=1)])
+            self.ncells = (ny-1)*(nx-1)
+            self.tri_cell = np.tile(np.arange(self.ncells), 2)
+            self.lon = self.lon.ravel()
+            self.lat = self.lat.ravel()
+        else:
+            raise Exception(
+                f"Topography file {self.filename} has no mesh connectivity (nv) or 2-D coordinates")
+        self.topo_lon = self.lon
+        self.topo_lat = self.lat
+
+    def create_mesh(self):
+        """Cell areas (m2) and centers from the triangles"""
+        tx = self.lon[self.triangles]
+        ty = self.lat[self.triangles]
+        coslat = np.cos(np.mean(ty, axis=1) * np.pi/180.)
+        x = tx * self.deg2m * coslat[:, np.newaxis]
+        y = ty * self.deg2m
+        tri_area = 0.5*np.abs((x[:, 1] - x[:, 0])*(y[:, 2] - y[:, 0])
+                              - (x[:, 2] - x[:, 0])*(y[:, 1] - y[:, 0]))
+        self.cell_area = np.bincount(
+            self.tri_cell, weights=tri_area, minlength=self.ncells)
+        # Area weighted centers
+        self.lonc = np.bincount(self.tri_cell, weights=tri_area*tx.mean(axis=1),
+                                minlength=self.ncells) / self.cell_area
+        self.latc = np.bincount(self.tri_cell, weights=tri_area*ty.mean(axis=1),
+                                minlength=self.ncells) / self.cell_area
+
+    def cell_index(self, chunk):
+        return self.locator.query(chunk.lon, chunk.lat)
+
+
+def _nearest_index(nodes, values):
+    """Index of the nearest node (nodes must be sorted)"""
+    middle = 0.5*(nodes[1:] + nodes[:-1])
+    return np.searchsorted(middle, values)
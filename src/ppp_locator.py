@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from .ppp_cache import file_key
+
+
+class CellLocator:
+    """
+    Lookup table that maps positions to the triangles of a mesh.
+    The domain is covered by regular buckets, every bucket lists the
+    triangles whose bounding box overlaps it. A query tests a position only
+    against the candidate triangles of its bucket, all positions of a batch
+    at once.
+    """
+
+    def __init__(self, x, y, triangles, tri_cell=None):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.triangles = np.asarray(triangles, dtype=np.intp)
+        # Cell of every triangle (e.g. two triangles per quad)
+        self.tri_cell = np.arange(len(self.triangles)) if tri_cell is None else np.asarray(
+            tri_cell, dtype=np.intp)
+        self.origin = None
+        self.bucket_size = None
+        self.nbuckets = None
+        self.bucket_start = None
+        self.bucket_triangles = None
+
+    def build(self):
+        """Build the bucket table"""
+        tx = self.x[self.triangles]
+        ty = self.y[self.triangles]
+        xmin, xmax = tx.min(axis=1), tx.max(axis=1)
+        ymin, ymax = ty.min(axis=1), ty.max(axis=1)
+        self.origin = np.array([xmin.min(), ymin.min()])
+        # About one triangle per bucket
+        extent = np.array([xmax.max(), ymax.max()]) - self.origin
+        self.bucket_size = max(np.sqrt(np.prod(extent) / len(self.triangles)),
+                               np.max(extent) / 4096.)
+        self.nbuckets = (np.floor(extent / self.bucket_size).astype(int) + 1)
+
+        ix0, iy0 = self._bucket_xy(xmin, ymin)
+        ix1, iy1 = self._bucket_xy(xmax, ymax)
+        nx = ix1 - ix0 + 1
+        ny = iy1 - iy0 + 1
+        # Every triangle is listed in all the buckets its bounding box covers
+        ntri_buckets = nx * ny
+        tri = np.repeat(np.arange(len(self.triangles)), ntri_buckets)
+        offset = np.arange(len(tri)) - \
+            np.repeat(np.cumsum(ntri_buckets) - ntri_buckets, ntri_buckets)
+        bx = ix0[tri] + offset % nx[tri]
+        by = iy0[tri] + offset // nx[tri]
+        bucket = by * self.nbuckets[0] + bx
+        order = np.argsort(bucket, kind="stable")
+        self.bucket_triangles = tri[order]
+        self.bucket_start = np.zeros(np.prod(self.nbuckets) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(bucket, minlength=np.prod(self.nbuckets)),
+                  out=self.bucket_start[1:])
+        return self
+
+    def _bucket_xy(self, x, y):
+        ix = np.floor((x - self.origin[0]) / self.bucket_size).astype(np.intp)
+        iy = np.floor((y - self.origin[1]) / self.bucket_size).astype(np.intp)
+        return ix, iy
+
+    def _bucket(self, x, y):
+        """Bucket of every position, -1 outside the table"""
+        with np.errstate(invalid="ignore"):
+            fx = np.floor((x - self.origin[0]) / self.bucket_size)
+            fy = np.floor((y - self.origin[1]) / self.bucket_size)
+            outside = ~((fx >= 0) & (fx < self.nbuckets[0])
+                        & (fy >= 0) & (fy < self.nbuckets[1]))
+        bucket = np.where(outside, -1, np.nan_to_num(fy) * self.nbuckets[0]
+                          + np.nan_to_num(fx)).astype(np.intp)
+        return bucket
+
+    def _inside(self, x, y, tri):
+        """Check if positions are inside (or on the edge of) triangles"""
+        vx = self.x[self.triangles[tri]]
+        vy = self.y[self.triangles[tri]]
+        d1 = (x - vx[:, 1]) * (vy[:, 0] - vy[:, 1]) - \
+            (vx[:, 0] - vx[:, 1]) * (y - vy[:, 1])
+        d2 = (x - vx[:, 2]) * (vy[:, 1] - vy[:, 2]) - \
+            (vx[:, 1] - vx[:, 2]) * (y - vy[:, 2])
+        d3 = (x - vx[:, 0]) * (vy[:, 2] - vy[:, 0]) - \
+            (vx[:, 2] - vx[:, 0]) * (y - vy[:, 0])
+        negative = (d1 < 0) | (d2 < 0) | (d3 < 0)
+        positive = (d1 > 0) | (d2 > 0) | (d3 > 0)
+        return ~(negative & positive)
+
+    def query(self, x, y, batch_size=1000000):
+        """
+        Cell index of every position, -1 outside the mesh.
+        Positions are processed in batches of batch_size.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        cells = np.full(len(x), -1, dtype=np.intp)
+        for b0 in range(0, len(x), batch_size):
+            b1 = min(b0 + batch_size, len(x))
+            cells[b0:b1] = self._query(x[b0:b1], y[b0:b1])
+        return cells.reshape(shape)
+
+    def _query(self, x, y):
+        bucket = self._bucket(x, y)
+        valid = bucket >= 0
+        start = np.where(valid, self.bucket_start[np.maximum(bucket, 0)], 0)
+        ncandidates = np.where(
+            valid, self.bucket_start[np.maximum(bucket, 0) + 1] - start, 0)
+        found = np.full(len(x), -1, dtype=np.intp)
+        # Test the j-th candidate of every position that is not found yet
+        for j in range(ncandidates.max() if len(x) else 0):
+            todo = np.flatnonzero((ncandidates > j) & (found < 0))
+            if (len(todo) == 0):
+                break
+            tri = self.bucket_triangles[start[todo] + j]
+            inside = self._inside(x[todo], y[todo], tri)
+            found[todo[inside]] = tri[inside]
+        cells = np.full(len(x), -1, dtype=np.intp)
+        cells[found >= 0] = self.tri_cell[found[found >= 0]]
+        return cells
+
+    def to_arrays(self):
+        return {"x": self.x, "y": self.y, "triangles": self.triangles,
+                "tri_cell": self.tri_cell, "origin": self.origin,
+                "bucket_size": self.bucket_size, "nbuckets": self.nbuckets,
+                "bucket_start": self.bucket_start, "bucket_triangles": self.bucket_triangles}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        locator = cls(arrays["x"], arrays["y"],
+                      arrays["triangles"], arrays["tri_cell"])
+        locator.origin = arrays["origin"]
+        locator.bucket_size = float(arrays["bucket_size"])
+        locator.nbuckets = arrays["nbuckets"]
+        locator.bucket_start = arrays["bucket_start"]
+        locator.bucket_triangles = arrays["bucket_triangles"]
+        return locator
+
+    @classmethod
+    def cached(cls, cache, topo_filename, x, y, triangles, tri_cell=None):
+        """
+        Load the table of the topography file from a cache (CountsCache),
+        or build it and store it there for the next run. Without a cache
+        the table is built.
+        """
+        if (cache is None):
+            return cls(x, y, triangles, tri_cell).build()
+        key = f"locator-{os.path.abspath(topo_filename)}-{file_key(topo_filename)}-{len(triangles)}"
+        arrays = cache.load(key)
+        if (arrays is not None):
+            return cls.from_arrays(arrays)
+        locator = cls(x, y, triangles, tri_cell).build()
+        cache.save(key, locator.to_arrays())
+        return locator
@@ -1,19 +1,100 @@
 #!/usr/bin/env python3
 
+import atexit
 import datetime
+import os
+import threading
+from collections import OrderedDict
 import numpy as np
 from netCDF4 import Dataset, num2date
 
 
+class DatasetPool:
+    """
+    Cache of open read-only netCDF datasets.
+    Files are opened on first use and kept open until they are evicted
+    (least recently used first) or the pool is closed. The pool can be used
+    as a context manager that closes all files on exit.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.nopened = 0
+        self._datasets = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close_all()
+        return False
+
+    def __contains__(self, fname):
+        return os.path.abspath(fname) in self._datasets
+
+    def get(self, fname):
+        key = os.path.abspath(fname)
+        with self.lock:
+            if (key in self._datasets):
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            dataset = Dataset(fname)
+            self.nopened += 1
+            self._datasets[key] = dataset
+            while (len(self._datasets) > self.maxsize):
+                _, old = self._datasets.popitem(last=False)
+                old.close()
+            return dataset
+
+    def close(self, fname):
+        """Close a file, e.g. before it is opened for writing"""
+        with self.lock:
+            dataset = self._datasets.pop(os.path.abspath(fname), None)
+            if (dataset is not None):
+                dataset.close()
+
+    def close_all(self):
+        with self.lock:
+            while (self._datasets):
+                _, dataset = self._datasets.popitem()
+                dataset.close()
+
+
+_pool = DatasetPool()
+atexit.register(_pool.close_all)
+
+
+def dataset_pool():
+    """Return the process-wide dataset pool"""
+    return _pool
+
+
+def open_dataset(fname):
+    return _pool.get(fname)
+
+
+def close_dataset(fname):
+    _pool.close(fname)
+
+
 def get_var(fname, vname, indices=None):
-    with Dataset(fname) as f:
+    """
+    Read a variable as a plain array. Fill values are not masked (a masked
+    array would be a mask and a copy on top of the data).
+    """
+    with _pool.lock:
+        f = open_dataset(fname)
+        var = f.variables[vname]
+        var.set_auto_mask(False)
         if (indices is not None):
-            return np.array(f.variables[vname][indices])
-        return np.array(f.variables[vname][:])
+            return np.asarray(var[indices])
+        return np.asarray(var[:])
 
 
 def get_time(fname, vname='time'):
-    with Dataset(fname) as f:
+    with _pool.lock:
+        f = open_dataset(fname)
         timein = f.variables[vname][:]
         timeunits = f.variables[vname].units
     return np.array([datetime.datetime(val.year, val.month, val.day, val.hour, val.minute, val.second) for val in num2date(timein, timeunits)])
@@ -21,10 +102,30 @@ def get_time(fname, vname='time'):
 
 def get_file_attributes(fname, attr_name):
     """Get global file attributes"""
-    with Dataset(fname) as f:
+    with _pool.lock:
+        f = open_dataset(fname)
         return list(f.__dict__[attr_name])
 
 
 def get_dimensions(fname):
-    with Dataset(fname) as f:
+    with _pool.lock:
+        f = open_dataset(fname)
         return f.dimensions.keys()
+
+
+def get_variables(fname):
+    with _pool.lock:
+        f = open_dataset(fname)
+        return f.variables.keys()
+
+
+def get_var_shape(fname, vname):
+    with _pool.lock:
+        f = open_dataset(fname)
+        return f.variables[vname].shape
+
+
+def get_var_dtype(fname, vname):
+    with _pool.lock:
+        f = open_dataset(fname)
+        return f.variables[vname].dtype
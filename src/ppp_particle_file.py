@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
-from .ppp_nc_funcs import get_var
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .ppp_nc_funcs import get_var, get_var_shape, get_var_dtype, get_time, get_variables
+from .ppp_binning import group_index
+from .ppp_profile import stage, record
 import numpy as np
 
 
@@ -8,21 +13,217 @@ PARTICLE_FILLVALUE = 9.e36
 PARTICLE_FILLVALUE_INT = -9999
 
 
+def index_runs(indices):
+    """Split sorted indices into contiguous (start, stop) runs"""
+    indices = np.asarray(indices)
+    if (len(indices) == 0):
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = indices[np.r_[0, breaks]]
+    stops = indices[np.r_[breaks - 1, len(indices) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def mask_fill_values(vname, data):
+    """Replace particle file fill values (in place)"""
+    if (vname == "state"):
+        data[data < PARTICLE_FILLVALUE_INT] = -1
+    else:
+        data[data > PARTICLE_FILLVALUE] = np.nan
+    return data
+
+
+class ParticleChunk:
+    """
+    Block of particle data along the time axis.
+    Variables are read from the particle file on first access.
+    """
+
+    def __init__(self, particle_file, start, stop, data=None):
+        self.particle_file = particle_file
+        self.start = start
+        self.stop = stop
+        self._data = {} if data is None else data
+        self.last_index = None
+
+    @property
+    def ntime(self):
+        return self.stop - self.start
+
+    def _get(self, vname):
+        if (vname not in self._data):
+            self._data[vname] = self.particle_file.read(
+                vname, slice(self.start, self.stop))
+        return self._data[vname]
+
+    @property
+    def id(self):
+        return self.particle_file.id
+
+    @property
+    def lon(self):
+        return self._get("lon")
+
+    @property
+    def lat(self):
+        return self._get("lat")
+
+    @property
+    def depth(self):
+        return self._get("depth")
+
+    @property
+    def state(self):
+        return self._get("state")
+
+
+class PrefetchStats:
+    """
+    Time spent reading blocks in the background and time the counting
+    waited for them. The read time that was not waited for was hidden
+    behind the counting of the previous blocks.
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.read_time = 0.
+        self.wait_time = 0.
+
+    def __iadd__(self, other):
+        self.chunks += other.chunks
+        self.read_time += other.read_time
+        self.wait_time += other.wait_time
+        return self
+
+    @property
+    def hidden_time(self):
+        return max(self.read_time - self.wait_time, 0.)
+
+    @property
+    def hidden_fraction(self):
+        return self.hidden_time / self.read_time if (self.read_time > 0) else 0.
+
+    def summary(self):
+        return (f"Prefetched {self.chunks} blocks: read {self.read_time:.2f} s, "
+                f"waited {self.wait_time:.2f} s, {100.*self.hidden_fraction:.0f}% "
+                f"of the read time hidden behind counting")
+
+
+# Prefetch statistics of this process, collected by Grid.get_all_counts
+_prefetch_stats = PrefetchStats()
+
+
+def take_prefetch_stats():
+    """Return the prefetch statistics of this process and start new ones"""
+    global _prefetch_stats
+    stats, _prefetch_stats = _prefetch_stats, PrefetchStats()
+    return stats
+
+
+class ChunkPrefetcher:
+    """
+    Iterator over blocks of time steps of a particle file that reads ahead.
+    While a block is counted, a background thread reads all variables of
+    the next depth blocks. Blocks are read into preallocated buffers that
+    are reused: depth + 1 sets, one for every block in the queue and one
+    for the block that is being counted. Fill values are masked in place.
+    A block is only valid until the next one is requested.
+    Only one thread reads: the netCDF library is not thread safe, reads
+    are serialized anyway.
+    """
+
+    def __init__(self, particle_file, variables, ntime_chunk, start, stop, depth=1):
+        self.particle_file = particle_file
+        self.variables = tuple(variables)
+        self.bounds = [(t0, min(t0 + ntime_chunk, stop))
+                       for t0 in range(start, stop, ntime_chunk)]
+        self.depth = max(depth, 1)
+        self.stats = PrefetchStats()
+
+    def _allocate(self):
+        pfile = self.particle_file
+        nrows = max(t1 - t0 for t0, t1 in self.bounds)
+        return {vname: np.empty((nrows, pfile.nparticles), dtype=pfile.read_dtype(vname))
+                for vname in self.variables}
+
+    def _read(self, buffers, t0, t1):
+        """Read a block into a set of buffers (in the background thread)"""
+        tic = time.perf_counter()
+        data = {vname: self.particle_file.read(vname, slice(t0, t1), out=buffer)
+                for vname, buffer in buffers.items()}
+        return data, time.perf_counter() - tic
+
+    def _fill(self, queue, blocks, free, executor):
+        """Queue reads of the next blocks, up to depth blocks or the free buffers"""
+        while (blocks and free and len(queue) < self.depth):
+            t0, t1 = blocks.popleft()
+            buffers = free.popleft()
+            queue.append((t0, t1, buffers, executor.submit(self._read, buffers, t0, t1)))
+
+    def __iter__(self):
+        global _prefetch_stats
+        if (len(self.bounds) == 0):
+            return
+        pfile = self.particle_file
+        # Shape and ids are read here, not in the background
+        pfile.shape
+        free = deque(self._allocate()
+                     for _ in range(min(self.depth + 1, len(self.bounds))))
+        blocks = deque(self.bounds)
+        queue = deque()
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            self._fill(queue, blocks, free, executor)
+            while (queue):
+                t0, t1, buffers, future = queue.popleft()
+                tic = time.perf_counter()
+                with stage("prefetch_wait"):
+                    data, read_time = future.result()
+                self.stats.wait_time += time.perf_counter() - tic
+                self.stats.read_time += read_time
+                self.stats.chunks += 1
+                # The next blocks are read while this one is counted
+                self._fill(queue, blocks, free, executor)
+                yield ParticleChunk(pfile, t0, t1, data)
+                free.append(buffers)
+        finally:
+            for _, _, _, future in queue:
+                future.cancel()
+            executor.shutdown(wait=True)
+            _prefetch_stats += self.stats
+
+
 class ParticleFile:
     """
     Particle file class.
     Stores particle data from a single file.
     """
 
-    def __init__(self, filename, id_list=None, ini_file=None):
+    # Above this many contiguous runs of selected particles, a filtered read
+    # fetches the whole span of particles at once and selects in memory
+    max_runs = 32
+    # Number of values read at once when converting to another dtype
+    read_block_size = 1 << 22
+
+    def __init__(self, filename, id_list=None, ini_file=None, member=0, dtype=None):
         self.filename = filename
+        # Floating point type of the coordinates, None keeps the file type
+        self.dtype = dtype
+        # Ensemble member number (layer label of the "member" sort)
+        self.member = member
         self._ini_file = ini_file
         self._lon = None
         self._lat = None
         self._depth = None
         self._state = None
-        self._indices = None
+        self._particles = None
+        self._runs = None
         self._id = None
+        self._time = None
+        self._elapsed = None
+        self._initial = None
+        # Time steps scanned for release times, first active step of every particle
+        self._release = None
 
         self._nids = None
         self._ntime = None
@@ -34,15 +235,261 @@ class ParticleFile:
         return
 
     def filter_ids(self):
-        id_mask = np.sum(
-            [self.id == id for id in self._id_list], axis=0, dtype=bool)
+        id_mask = np.isin(self.id, self._id_list)
         self._id = self.id[id_mask]
-        self._indices = (..., id_mask)
+        # Selected particles as contiguous runs, read as hyperslabs
+        self._particles = np.flatnonzero(id_mask)
+        self._runs = index_runs(self._particles)
+
+    def read(self, vname, time_slice=None, out=None, particles=None):
+        """
+        Read a (time, particle) variable, optionally only a block of time steps
+        and only some particles (indices of the selected particles).
+        With out, the values are read into the first rows of out (of dtype
+        read_dtype(vname)) and a view of these rows is returned.
+        """
+        if (time_slice is None):
+            time_slice = slice(None)
+        convert = self.dtype is not None and vname != "state"
+        if (out is None and not convert):
+            return self._read(vname, time_slice, particles)
+        # Converted (or copied) block by block, the file type is never in memory in full
+        start, stop, _ = time_slice.indices(self.ntime)
+        nparticles = self.nparticles if particles is None else len(particles)
+        if (out is None):
+            data = np.empty((max(stop - start, 0), nparticles), dtype=self.dtype)
+        else:
+            data = out[:max(stop - start, 0)]
+        nblock = max(self.read_block_size // max(nparticles, 1), 1)
+        for t0 in range(start, stop, nblock):
+            t1 = min(t0 + nblock, stop)
+            data[t0-start:t1-start] = self._read(vname, slice(t0, t1), particles)
+        return data
+
+    def read_dtype(self, vname):
+        """Type of a variable as returned by read"""
+        if (self.dtype is not None and vname != "state"):
+            return np.dtype(self.dtype)
+        return get_var_dtype(self.filename, vname)
+
+    def _read(self, vname, time_slice, particles=None):
+        # Particles in the file and their contiguous runs
+        if (particles is None):
+            particles, runs = self._particles, self._runs
+        else:
+            if (self._particles is not None):
+                particles = self._particles[particles]
+            runs = index_runs(particles)
+        with stage("read"):
+            if (particles is None):
+                data = get_var(self.filename, vname, indices=(time_slice,))
+            elif (len(runs) == 0):
+                data = get_var(self.filename, vname,
+                               indices=(time_slice, slice(0, 0)))
+            elif (len(runs) <= self.max_runs):
+                data = np.concatenate([get_var(self.filename, vname, indices=(time_slice, slice(start, stop)))
+                                       for start, stop in runs], axis=1)
+            else:
+                first = runs[0][0]
+                last = runs[-1][1]
+                data = get_var(self.filename, vname, indices=(
+                    time_slice, slice(first, last)))[:, particles - first]
+        record("read", bytes_read=data.nbytes)
+        with stage("mask"):
+            return mask_fill_values(vname, data)
+
+    def iter_chunks(self, ntime_chunk=None, start=0, stop=None, variables=None, prefetch=0):
+        """
+        Iterate over time steps start...stop in blocks of ntime_chunk time steps.
+        The whole range is a single block if ntime_chunk is None.
+        With prefetch > 0, the variables of the next prefetch blocks are read
+        in a background thread (see ChunkPrefetcher), a block is then only
+        valid until the next one is requested.
+        """
+        if (stop is None or stop > self.ntime):
+            stop = self.ntime
+        if (ntime_chunk is None or ntime_chunk <= 0):
+            ntime_chunk = max(stop - start, 1)
+        if (prefetch > 0 and variables):
+            yield from ChunkPrefetcher(self, variables, ntime_chunk, start, stop, prefetch)
+            return
+        for t0 in range(start, stop, ntime_chunk):
+            yield ParticleChunk(self, t0, min(t0 + ntime_chunk, stop))
+
+    def time_windows(self, window):
+        """
+        Split the time axis into consecutive windows.
+        window is a number of time steps, "daily" or "monthly".
+        Returns a list of (start, stop) time index ranges.
+        """
+        if (str(window).isdigit()):
+            nstep = int(window)
+            if (nstep <= 0):
+                raise ValueError("Time window must be a positive number of steps")
+            return [(start, min(start + nstep, self.ntime))
+                    for start in range(0, self.ntime, nstep)]
+        if (window == "daily"):
+            keys = [(t.year, t.month, t.day) for t in self.time]
+        elif (window == "monthly"):
+            keys = [(t.year, t.month) for t in self.time]
+        else:
+            raise ValueError(f"Unknown time window: {window}")
+        starts = [0] + [i for i in range(1, len(keys))
+                        if keys[i] != keys[i-1]]
+        return list(zip(starts, starts[1:] + [len(keys)]))
+
+    def last_positions(self, ntime_chunk=None, start=0, stop=None, variables=("lon", "lat", "state")):
+        """
+        Find the last active (non-NaN) position of every particle.
+        The time steps start...stop are scanned backwards in blocks of
+        ntime_chunk steps (by default about read_block_size values), the scan
+        stops as soon as every particle is found. Only the particles that are
+        not found yet are read.
+        Returns a single time step ParticleChunk with the variables at the last
+        active position (NaN/fill for particles that are never active), the
+        time index of the position is stored in its last_index attribute.
+        """
+        if (stop is None or stop > self.ntime):
+            stop = self.ntime
+        nparticles = self.nparticles
+        if (ntime_chunk is None or ntime_chunk <= 0):
+            ntime_chunk = max(self.read_block_size // max(nparticles, 1), 1)
+        last_index = np.full(nparticles, -1, dtype=int)
+        data = {}
+        for t1 in range(stop, start, -ntime_chunk):
+            t0 = max(t1 - ntime_chunk, start)
+            todo = np.flatnonzero(last_index < 0)
+            if (len(todo) == 0):
+                break
+            particles = None if len(todo) == nparticles else todo
+            block = {vname: self.read(vname, slice(t0, t1), particles=particles)
+                     for vname in variables}
+            active = ~(np.isnan(block["lon"]) | np.isnan(block["lat"]))
+            found = active.any(axis=0)
+            # Last active row of every column: first active row of the reversed block
+            irow = active.shape[0] - 1 - np.argmax(active[::-1], axis=0)
+            for vname, values in block.items():
+                if (vname not in data):
+                    data[vname] = np.full((1, nparticles), -1 if vname == "state" else np.nan,
+                                          dtype=values.dtype)
+                data[vname][0, todo[found]] = values[irow[found], found]
+            last_index[todo[found]] = t0 + irow[found]
+        for vname in variables:
+            data.setdefault(vname, np.full((1, nparticles), -1 if vname == "state" else np.nan))
+        chunk = ParticleChunk(self, 0, 1, data)
+        chunk.last_index = last_index
+        return chunk
+
+    def initial_positions(self, variables=("lon", "lat", "depth")):
+        """
+        Release position of every particle, as a single time step ParticleChunk
+        with the position variables (lon, lat, depth) in variables.
+        The ini file is either a netCDF file with lon, lat (and depth) of every
+        particle, or a text file with one release point per row
+        (id lon lat [depth]) that is matched to the particle ids.
+        Without an ini file the first active position of every particle in the
+        particle file is used (NaN if it is never active).
+        """
+        variables = tuple(vname for vname in variables if vname in ("lon", "lat", "depth"))
+        if (self._initial is not None and self._initial[0] == variables):
+            return self._initial[1]
+        nparticles = self.nparticles
+        if (self._ini_file is None):
+            first = self.first_active(self.ntime)
+            data = {vname: np.full((1, nparticles), np.nan) for vname in variables}
+            ntime_chunk = max(self.read_block_size // max(nparticles, 1), 1)
+            for t0 in range(0, self.ntime, ntime_chunk):
+                t1 = min(t0 + ntime_chunk, self.ntime)
+                # Only the particles released in this block are read
+                released = np.flatnonzero((first >= t0) & (first < t1))
+                if (len(released) == 0):
+                    continue
+                for vname in variables:
+                    values = self.read(vname, slice(t0, t1), particles=released)
+                    data[vname][0, released] = values[first[released] - t0,
+                                                      np.arange(len(released))]
+        elif (self._ini_file.endswith(".nc")):
+            data = {}
+            for vname in variables:
+                if (vname not in get_variables(self._ini_file)):
+                    data[vname] = np.zeros((1, nparticles))
+                    continue
+                values = get_var(self._ini_file, vname)
+                values = values.reshape((-1, values.shape[-1]))[:1]
+                if (self._particles is not None):
+                    values = values[:, self._particles]
+                data[vname] = mask_fill_values(vname, values)
+        else:
+            rows = np.loadtxt(self._ini_file, ndmin=2)
+            rows = rows[np.argsort(rows[:, 0], kind="stable")]
+            index = group_index(self.id, rows[:, 0])
+            data = {}
+            for vname, column in (("lon", 1), ("lat", 2), ("depth", 3)):
+                if (vname not in variables):
+                    continue
+                values = rows[:, column] if column < rows.shape[1] else np.zeros(len(rows))
+                data[vname] = np.where(index >= 0, values[index], np.nan)[
+                    np.newaxis, :]
+        data["state"] = np.zeros((1, nparticles), dtype=int)
+        self._initial = (variables, ParticleChunk(self, 0, 1, data))
+        return self._initial[1]
+
+    @property
+    def time(self):
+        if (self._time is None):
+            self._time = get_time(self.filename)
+        return self._time
+
+    @property
+    def elapsed(self):
+        """Time of every time step in seconds since the first time step"""
+        if (self._elapsed is None):
+            self._elapsed = np.array([(t - self.time[0]).total_seconds() for t in self.time])
+        return self._elapsed
+
+    @property
+    def durations(self):
+        """Length of every time step in seconds (the last one as the one before)"""
+        elapsed = self.elapsed
+        if (len(elapsed) < 2):
+            return np.zeros(len(elapsed))
+        return np.append(np.diff(elapsed), elapsed[-1] - elapsed[-2])
+
+    def first_active(self, stop, ntime_chunk=None):
+        """
+        Time index of the first active position of every particle before time
+        step stop, -1 if it is not active before stop. The time steps are
+        scanned forward in blocks of ntime_chunk steps (by default about
+        read_block_size values) until every particle is found, only the
+        particles that are not found yet are read. Scanned steps are kept for
+        later calls.
+        """
+        if (self._release is None):
+            self._release = (0, np.full(self.nparticles, -1, dtype=int))
+        scanned, first = self._release
+        if (ntime_chunk is None or ntime_chunk <= 0):
+            ntime_chunk = max(self.read_block_size // max(self.nparticles, 1), 1)
+        for t0 in range(scanned, stop, ntime_chunk):
+            todo = np.flatnonzero(first < 0)
+            if (len(todo) == 0):
+                break
+            t1 = min(t0 + ntime_chunk, stop)
+            particles = None if len(todo) == len(first) else todo
+            active = ~np.isnan(self.read("lon", slice(t0, t1), particles=particles))
+            found = active.any(axis=0)
+            first[todo[found]] = t0 + np.argmax(active[:, found], axis=0)
+            scanned = t1
+        self._release = (max(scanned, stop), first)
+        return np.where(first < stop, first, -1)
 
-    def positions(self):
-        x = self.lon.flatten()
-        y = self.lat.flatten()
-        return np.concatenate((x[:, np.newaxis], y[:, np.newaxis]), axis=1)
+    def release_times(self, stop, ntime_chunk=None):
+        """
+        Time (seconds since the first time step) of the first active position
+        of every particle before time step stop, NaN if it is not active
+        before stop (see first_active)
+        """
+        first = self.first_active(stop, ntime_chunk)
+        return np.where(first >= 0, self.elapsed[np.maximum(first, 0)], np.nan)
 
     @property
     def nids(self):
@@ -63,44 +510,39 @@ class ParticleFile:
     @property
     def shape(self):
         if (self._ntime is None or self._nparticles is None):
-            self._ntime, self._nparticles = self.lon.shape
+            self._ntime = get_var_shape(self.filename, "lon")[0]
+            self._nparticles = len(self.id)
         return (self._ntime, self._nparticles)
 
     @property
     def id(self):
         if (self._id is None):
-            self._id = get_var(self.filename, "id", indices=self._indices)
+            self._id = get_var(self.filename, "id")
             self._id[self._id > PARTICLE_FILLVALUE] = np.nan
         return self._id
 
     @property
     def lon(self):
         if (self._lon is None):
-            self._lon = get_var(self.filename, "lon", indices=self._indices)
-            self._lon[self._lon > PARTICLE_FILLVALUE] = np.nan
+            self._lon = self.read("lon")
         return self._lon
 
     @property
     def lat(self):
         if (self._lat is None):
-            self._lat = get_var(self.filename, "lat", indices=self._indices)
-            self._lat[self._lat > PARTICLE_FILLVALUE] = np.nan
+            self._lat = self.read("lat")
         return self._lat
 
     @property
     def depth(self):
         if(self._depth is None):
-            self._depth = get_var(
-                self.filename, "depth", indices=self._indices)
-            self._depth[self._depth > PARTICLE_FILLVALUE] = np.nan
+            self._depth = self.read("depth")
         return self._depth
 
     @property
     def state(self):
         if(self._state is None):
-            self._state = get_var(
-                self.filename, "state", indices=self._indices)
-            self._state[self._state < PARTICLE_FILLVALUE_INT] = -1
+            self._state = self.read("state")
         return self._state
 
 
@@ -1,4 +1,323 @@
 #!/usr/bin/env python3
 
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, Normalize
+from .ppp_result_file import ResultsFile
+
+
+def reduction_factors(shape, pixels):
+    """Block size per axis so that shape fits in the given number of pixels"""
+    return tuple(max(int(np.ceil(n / max(p, 1))), 1) for n, p in zip(shape, pixels))
+
+
+def block_reduce(data, factors, how="mean"):
+    """
+    Reduce the last two axes of data by blocks of factors cells, ignoring
+    NaN (e.g. land). The axes are padded with NaN to a multiple of the
+    block size. Blocks that are all NaN stay NaN.
+    """
+    fy, fx = factors
+    if (fy == 1 and fx == 1):
+        return data
+    ny, nx = data.shape[-2:]
+    pad = [(0, 0)] * (data.ndim - 2) + [(0, -ny % fy), (0, -nx % fx)]
+    data = np.pad(data.astype(float), pad, constant_values=np.nan)
+    blocks = data.reshape(data.shape[:-2] + (data.shape[-2] // fy, fy,
+                                             data.shape[-1] // fx, fx))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        if (how == "sum"):
+            reduced = np.nansum(blocks, axis=(-3, -1))
+            reduced[np.isnan(blocks).all(axis=(-3, -1))] = np.nan
+        elif (how == "max"):
+            reduced = np.nanmax(blocks, axis=(-3, -1))
+        else:
+            reduced = np.nanmean(blocks, axis=(-3, -1))
+    return reduced
+
+
+def bin_cells(x, y, values, extent, pixels, how="mean"):
+    """
+    Reduce scattered cell values (unstructured grids) onto a pixel raster.
+    Where cells are further apart than pixels, empty pixels take the mean of
+    their neighbours, up to about the mean cell spacing. Other pixels
+    without cells are NaN.
+    """
+    x0, x1, y0, y1 = extent
+    ny, nx = pixels
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    valid = inside & np.isfinite(values)
+    ix = np.minimum(((x[valid] - x0) / (x1 - x0) * nx).astype(int), nx - 1)
+    iy = np.minimum(((y[valid] - y0) / (y1 - y0) * ny).astype(int), ny - 1)
+    index = iy * nx + ix
+    total = np.bincount(index, weights=values[valid], minlength=nx*ny)
+    ncells = np.bincount(index, minlength=nx*ny)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        raster = total if how == "sum" else total / ncells
+    raster = np.where(ncells > 0, raster, np.nan).reshape(ny, nx)
+    # Mean cell spacing in pixels (cells are counted even if their value is NaN)
+    spacing = np.sqrt(nx * ny / max(np.count_nonzero(inside), 1))
+    for i in range(int(np.ceil(spacing))):
+        empty = np.isnan(raster)
+        if (not empty.any()):
+            break
+        raster = _fill_from_neighbours(raster, empty)
+    return raster
+
+
+def _fill_from_neighbours(raster, empty):
+    """Set empty pixels to the mean of their non-empty neighbours (if any)"""
+    padded = np.pad(raster, 1, constant_values=np.nan)
+    ny, nx = raster.shape
+    neighbours = np.stack([padded[1+dy:1+dy+ny, 1+dx:1+dx+nx]
+                           for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1))])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        fill = np.nanmean(neighbours, axis=0)
+    return np.where(empty, fill, raster)
+
+
+def label_name(label):
+    """Label of a layer as text, integer valued ids/states without decimals"""
+    if (isinstance(label, (float, np.floating)) and float(label).is_integer()):
+        return str(int(label))
+    return str(label)
+
+
+def _edges(lower):
+    """Extent (first edge, last edge) of cells given by their regularly spaced lower edges"""
+    step = lower[1] - lower[0] if len(lower) > 1 else 1.
+    return lower[0], lower[-1] + step
+
+
+def _window_slice(lower, start, stop):
+    """Slice of the cells (given by their lower edges) that overlap [start, stop]"""
+    if (start >= _edges(lower)[1]):
+        return slice(len(lower), len(lower))
+    return slice(max(np.searchsorted(lower, start, side="right") - 1, 0),
+                 np.searchsorted(lower, stop))
+
+
 class ParticlePlot:
-    pass
\ No newline at end of file
+    """
+    Plot maps of counts or concentration from a results file.
+    Only the requested layer and window are read, grids with more cells
+    than output pixels are block reduced to about the pixel size before
+    drawing (counts are summed, concentrations averaged). The figure,
+    image and colormap are set up once and reused for every layer.
+    """
+
+    def __init__(self, filename, group="all", quantity="concentration", width=800, height=600,
+                 dpi=100, cmap="viridis", log=False, vmin=None, vmax=None, window=None,
+                 time=None, depth=0):
+        self.filename = filename
+        self.group = group
+        self.quantity = quantity
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.cmap = cmap
+        self.log = log
+        self.vmin = vmin
+        self.vmax = vmax
+        # (lon0, lon1, lat0, lat1) in coordinate units
+        self.window = window
+        # Time step of a time series (last by default), depth level of a volume
+        self.time = time
+        self.depth = depth
+        self.how = "sum" if quantity == "counts" else "mean"
+        self.results = ResultsFile(filename, None)
+        self.results.read()
+        if ((group, quantity) not in self.results.quantities):
+            raise Exception(f"Results file has no {group} {quantity}")
+        self._select_window()
+        self.fig = None
+        self.ax = None
+        self.image = None
+        self.colorbar = None
+
+    def _select_window(self):
+        """Index slices and coordinates of the plotted window"""
+        results = self.results
+        self.xlabel, self.ylabel = "Longitude", "Latitude"
+        if (results.type == "profile"):
+            x, y = results.lon, results.depth
+            xdim, ydim = "lon", "depth"
+            self.xlabel, self.ylabel = "Longitude", "Depth"
+        else:
+            x, y = results.lon, results.lat
+            xdim, ydim = "lon", "lat"
+        if (results.type == "mesh"):
+            # Cells are scattered, the window is applied when rasterizing
+            self.slices = {}
+            self.x, self.y = x, y
+            return
+        xsel, ysel = slice(None), slice(None)
+        if (self.window is not None):
+            x0, x1, y0, y1 = self.window
+            xsel = _window_slice(x, x0, x1)
+            if (ydim == "lat"):
+                ysel = _window_slice(y, y0, y1)
+            else:
+                # Depth goes down, the window is given as (top, bottom)
+                ysel = _window_slice(y, min(y0, y1), max(y0, y1))
+            if (xsel.start == xsel.stop or ysel.start == ysel.stop):
+                raise Exception("Plot window does not overlap the grid")
+        self.slices = {xdim: xsel, ydim: ysel}
+        if (results.type == "volume"):
+            self.slices["depth"] = self.depth
+        self.x, self.y = x[xsel], y[ysel]
+
+    def layers(self):
+        """Indices and labels of the layers of the group"""
+        labels = self.results.labels(self.group)
+        if (labels is None):
+            return [(None, "all")]
+        return list(enumerate(labels))
+
+    def read(self, layer=None):
+        """Read one layer (within the window) and reduce it to the pixel size"""
+        self.setup()
+        time = None
+        if (self.results.time is not None):
+            time = len(self.results.time) - 1 if self.time is None else self.time
+        data = self.results.get(self.group, self.quantity, layer=layer,
+                                time=time, **self.slices)
+        if (self.results.type == "mesh"):
+            return bin_cells(self.x, self.y, np.asarray(data, dtype=float), self.extent(),
+                             self.pixels(), self.how)
+        return block_reduce(data, reduction_factors(data.shape, self.pixels()), self.how)
+
+    def extent(self):
+        if (self.results.type == "mesh" and self.window is None):
+            return (self.x.min(), self.x.max(), self.y.min(), self.y.max())
+        if (self.results.type == "mesh"):
+            return tuple(self.window)
+        return _edges(self.x) + _edges(self.y)
+
+    def pixels(self):
+        """Size (rows, columns) of the map area in output pixels"""
+        if (self.ax is None):
+            return (self.height, self.width)
+        bbox = self.ax.get_window_extent()
+        return (int(bbox.height), int(bbox.width))
+
+    def setup(self):
+        """Create the figure, image and colorbar that are reused for every layer"""
+        if (self.fig is not None):
+            return
+        self.fig, self.ax = plt.subplots(
+            figsize=(self.width/self.dpi, self.height/self.dpi), dpi=self.dpi)
+        cmap = plt.get_cmap(self.cmap).copy()
+        cmap.set_bad("lightgrey")
+        # Placeholder limits, every draw() sets the limits of its layer
+        norm = LogNorm(1., 10.) if self.log else Normalize(0., 1.)
+        self.image = self.ax.imshow(np.full((2, 2), np.nan), origin="lower", cmap=cmap,
+                                    norm=norm, extent=self.extent(), aspect="auto",
+                                    interpolation="nearest")
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax)
+        self.colorbar.set_label(
+            f"{self.quantity} ({self._units()})" if self._units() else self.quantity)
+        self.ax.set_xlabel(self.xlabel)
+        self.ax.set_ylabel(self.ylabel)
+        if (self.results.type == "profile"):
+            self.ax.invert_yaxis()
+
+    def _units(self):
+        concentration = "particles/m3" if self.results.type == "volume" else "particles/m2"
+        return {"counts": "particles/cell",
+                "concentration": concentration,
+                "smoothed_concentration": concentration,
+                "residence_time": "s", "age": "s", "arrival_time": "s"}.get(self.quantity)
+
+    def draw(self, data, title=None):
+        self.setup()
+        if (self.results.type != "mesh"):
+            # Padding of the last block extends the image beyond the window
+            fy, fx = reduction_factors((len(self.y), len(self.x)), self.pixels())
+            x0, x1, y0, y1 = self.extent()
+            x1 = x0 + (x1 - x0) / len(self.x) * data.shape[1] * fx
+            y1 = y0 + (y1 - y0) / len(self.y) * data.shape[0] * fy
+            self.image.set_extent((x0, x1, y0, y1))
+            self.ax.set_xlim(self.extent()[:2])
+            self.ax.set_ylim(self.extent()[2:][::-1] if self.results.type == "profile"
+                             else self.extent()[2:])
+        if (self.log):
+            data = np.where(data > 0, data, np.nan)
+        self.image.set_data(np.ma.masked_invalid(data))
+        finite = data[np.isfinite(data)]
+        vmin = self.vmin if self.vmin is not None else (finite.min() if finite.size else 1.)
+        vmax = self.vmax if self.vmax is not None else (finite.max() if finite.size else 1.)
+        if (vmax <= vmin):
+            vmax = vmin * 10. if self.log else vmin + 1.
+        self.image.set_clim(vmin, vmax)
+        self.ax.set_title(title if title is not None else "")
+
+    def render(self, layer, label, filename):
+        data = self.read(layer)
+        title = f"{self.quantity}" if layer is None else f"{self.quantity} {self.group} {label_name(label)}"
+        self.draw(data, title)
+        self.fig.savefig(filename, dpi=self.dpi)
+        return filename
+
+    def close(self):
+        if (self.fig is not None):
+            plt.close(self.fig)
+            self.fig = None
+
+    def output_names(self, out_file, layers):
+        """File name of every layer: the label is added before the extension"""
+        if (len(layers) == 1 and layers[0][0] is None):
+            return [out_file]
+        base, ext = os.path.splitext(out_file)
+        return [f"{base}_{self.group}{label_name(label)}{ext or '.png'}" for layer, label in layers]
+
+    def plot(self, out_file, layers=None, workers=1):
+        """
+        Render the given (index, label) layers, all layers of the group by
+        default. With workers > 1 the layers are split in batches that are
+        rendered in a process pool, every worker sets up its figure once.
+        Returns the names of the files written.
+        """
+        if (layers is None):
+            layers = self.layers()
+        filenames = self.output_names(out_file, layers)
+        if (workers is None or workers <= 1 or len(layers) <= 1):
+            written = [self.render(layer, label, filename)
+                       for (layer, label), filename in zip(layers, filenames)]
+            self.close()
+            return written
+        settings = self.settings()
+        nbatches = min(workers, len(layers))
+        batches = np.array_split(np.arange(len(layers)), nbatches)
+        # Spawn fresh interpreters: netCDF/HDF5 state must not be shared by fork
+        with ProcessPoolExecutor(max_workers=nbatches,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_render_batch, settings,
+                                   [layers[i] for i in batch], [filenames[i] for i in batch])
+                       for batch in batches]
+            written = [filename for future in futures for filename in future.result()]
+        return written
+
+    def settings(self):
+        """Arguments to create the same plot in another process"""
+        return {"filename": self.filename, "group": self.group, "quantity": self.quantity,
+                "width": self.width, "height": self.height, "dpi": self.dpi,
+                "cmap": self.cmap, "log": self.log, "vmin": self.vmin, "vmax": self.vmax,
+                "window": self.window, "time": self.time, "depth": self.depth}
+
+
+def _render_batch(settings, layers, filenames):
+    """Render a batch of layers with one figure (runs in a worker process)"""
+    plot = ParticlePlot(**settings)
+    written = [plot.render(layer, label, filename)
+               for (layer, label), filename in zip(layers, filenames)]
+    plot.close()
+    return written
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+import time
+from .ppp_particle_file import ParticleFile
+from .ppp_result_file import ResultsFile
+from .ppp_grid import HorizontalGrid, VerticalGrid, VolumeGrid, UnstructuredGrid, worker_pool
+from .ppp_quantity import Concentration, Counts, Connectivity, SmoothedConcentration, ResidenceTime, ParticleAge, ArrivalTime
+from .ppp_nc_funcs import close_dataset, get_dimensions, get_variables, get_var_shape
+from .ppp_binning import merge_counts
+from .ppp_cache import CountsCache, counts_from_arrays, counts_to_arrays, file_key, header_hash
+from .ppp_profile import stage
+
+
+def expand_sources(patterns):
+    """Expand glob patterns of particle files, other names are kept as they are"""
+    sources = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        for filename in (matches if matches else [pattern]):
+            if (filename not in sources):
+                sources.append(filename)
+    return sources
+
+
+def read_previous_counts(result_file, sort_by, shape):
+    """
+    Counts of an existing results file (metadata already read), to be
+    updated with new data
+    """
+    counts = {}
+    for sort_type in sort_by:
+        if ((sort_type, "counts") not in result_file.quantities):
+            raise Exception(
+                f"Results file {result_file.filename} has no {sort_type} counts")
+        data = result_file.get(sort_type, "counts")
+        labels = result_file.labels(sort_type)
+        if (data.shape[-len(shape):] != shape):
+            raise Exception(
+                f"Results file {result_file.filename} has a different grid")
+        counts[sort_type] = (data, labels)
+    return counts
+
+
+def count_new_steps(grid, particle_files, starts, sort_by, chunk_size, workers, sparse=False, prefetch=0, pool=None):
+    """
+    Counts of the time steps of every particle file from its start index on.
+    Files with the same start index are counted together.
+    Returns None if there are no new time steps.
+    """
+    partials = []
+    for start in sorted(set(starts)):
+        pfiles = [pfile for pfile, pstart in zip(particle_files, starts)
+                  if pstart == start and pfile.ntime > start]
+        if (len(pfiles) > 0):
+            partials.append(grid.get_all_counts(
+                pfiles, sort_by, chunk_size, workers, start, sparse=sparse, prefetch=prefetch, pool=pool))
+    if (len(partials) == 0):
+        return None
+    return {sort_type: merge_counts(grid.shape, *[partial[sort_type] for partial in partials])
+            for sort_type in sort_by}
+
+
+def counts_key(grid, particle_files, options, sort, start, stop):
+    """
+    Cache key of the counts of a sort type: identity of the particle and
+    topography files and every option that changes the counts
+    """
+    key = dict(options)
+    key.update({"sort": sort, "start": start, "stop": stop,
+                "grid": {"type": grid.type, "topo": file_key(grid.filename),
+                         "resolution": getattr(grid, "resolution", None),
+                         "depth_resolution": getattr(grid, "depth_resolution", None),
+                         "mask_land": getattr(grid, "mask_land", False),
+                         "lat_band": getattr(grid, "lat_band", None),
+                         "shape": list(grid.shape)},
+                "sources": [(file_key(pfile.filename), header_hash(pfile.filename))
+                            for pfile in particle_files]})
+    return json.dumps(key, sort_keys=True, default=str)
+
+
+def cached_counts(cache, grid, particle_files, sorts, options, chunk_size, workers,
+                  start=0, stop=None, last=False, sparse=False, prefetch=0, pool=None):
+    """
+    Grid.get_all_counts with a counts cache: sort types that are in the
+    cache are loaded, the others are counted (in one pass) and stored
+    """
+    if (cache is None):
+        return grid.get_all_counts(particle_files, sorts, chunk_size, workers,
+                                   start, stop, last, sparse, prefetch, pool)
+    options = dict(options, last=last)
+    keys = {sort: counts_key(grid, particle_files, options, sort, start, stop)
+            for sort in sorts}
+    counts = {}
+    for sort in sorts:
+        arrays = cache.load(keys[sort])
+        if (arrays is not None):
+            print(f"Using cached {sort} counts")
+            counts[sort] = counts_from_arrays(sort, arrays, grid.shape, sparse)
+    missing = [sort for sort in sorts if sort not in counts]
+    if (len(missing) > 0):
+        new_counts = grid.get_all_counts(particle_files, missing, chunk_size, workers,
+                                         start, stop, last, sparse, prefetch, pool)
+        for sort in missing:
+            cache.save(keys[sort], counts_to_arrays(sort, new_counts[sort]))
+        counts.update(new_counts)
+    return {sort: counts[sort] for sort in sorts}
+
+
+def check_options(args, sources, update):
+    """
+    Raise an exception for options that can not be combined, print a
+    warning for options that have no effect
+    """
+    if (update and (args.time_window is not None or args.last or args.connectivity)):
+        raise Exception(
+            "Time series, last position and connectivity results can not be updated")
+    if (args.time_stats and (update or args.last or args.sparse_file)):
+        raise Exception(
+            "Residence time and age can not be updated, computed from last positions or stored in sparse results files")
+    if (args.connectivity and args.time_window is not None):
+        raise Exception("Connectivity can not be computed for time windows")
+    if (args.lat_band is not None and args.grid != "profile"):
+        raise Exception("A latitude band can only be given for profile grids")
+    if (args.prefetch < 0):
+        raise Exception("Prefetch depth must be zero or positive")
+    if (args.bandwidth is not None and args.bandwidth < 0):
+        raise Exception("Bandwidth must be positive (0: no smoothed concentration)")
+    # The sparse file layout only stores occupied cells
+    if (args.bandwidth and (args.grid not in ("map", "volume") or args.sparse_file)):
+        raise Exception(
+            "The smoothed concentration needs a map or volume grid and can not be stored in sparse results files")
+    if (args.last and args.workers > 1 and len(sources) == 1):
+        print("Warning: last positions of a single particle file are found by one process, --workers is ignored")
+
+
+def dry_run(args, sources):
+    """
+    Check the particle, topography and ini files without processing them.
+    Only the netCDF headers (dimensions, variable names and shapes) are read.
+    """
+    problems = []
+    # Particle variables that are read: time, ids and what the grid counts
+    grid_class = {"map": HorizontalGrid, "profile": VerticalGrid,
+                  "volume": VolumeGrid, "mesh": UnstructuredGrid}[args.grid]
+    needed = ["time", "id"] + list(grid_class.particle_variables(args.sort))
+    for filename in sources:
+        if (not os.path.exists(filename)):
+            problems.append(f"{filename}: file not found")
+            continue
+        try:
+            variables = get_variables(filename)
+        except OSError as err:
+            problems.append(f"{filename}: not a netCDF file ({err})")
+            continue
+        missing = [vname for vname in needed if vname not in variables]
+        if (missing):
+            problems.append(f"{filename}: no variable(s) {', '.join(missing)}")
+            continue
+        shape = get_var_shape(filename, "lon")
+        if (len(shape) != 2 or get_var_shape(filename, "id") != shape[1:]):
+            problems.append(f"{filename}: lon is not a (time, particle) variable")
+            continue
+        print(f"{filename}: {shape[0]} time steps, {shape[1]} particles")
+
+    topo = args.topo
+    if (not os.path.exists(topo)):
+        problems.append(f"{topo}: file not found")
+    else:
+        try:
+            variables = get_variables(topo)
+            names = set(get_dimensions(topo)) if args.grid != "mesh" else set(variables)
+            if (not names.intersection(["lon", "lonc", "longitude"]) or
+                    not names.intersection(["lat", "latc", "latitude"])):
+                problems.append(f"{topo}: no lon/lat {'variables' if args.grid == 'mesh' else 'dimensions'}")
+            if (args.grid != "mesh" and "bathymetry" not in variables):
+                problems.append(f"{topo}: no variable bathymetry")
+        except OSError as err:
+            problems.append(f"{topo}: not a netCDF file ({err})")
+
+    if (args.ini_file is not None and not os.path.exists(args.ini_file)):
+        problems.append(f"{args.ini_file}: file not found")
+    if (args.connectivity and args.ini_file is None):
+        print("No --ini-file: connectivity sources are the first positions")
+
+    if (problems):
+        raise Exception("Dry run found problems:\n" + "\n".join(problems))
+    print(f"Dry run OK: {len(sources)} particle file(s), {args.grid} grid of {topo}, "
+          f"results would be written to {args.out_file}")
+
+
+def process(args):
+    print("Processing")
+    overwrite = args.overwrite
+    sources = expand_sources(args.source)
+    result_filename = args.out_file
+    topo_filename = args.topo
+    resolution = args.resolution
+    grid_type = args.grid
+    depth_resolution = args.depth_resolution
+    mask_land = args.mask_land
+    follow = args.follow
+    update = args.update or follow is not None
+
+    result_file = ResultsFile(result_filename, sources)
+
+    if (result_file.exists and overwrite == False and update == False):
+        raise Exception(
+            f"Results file {result_filename} already exists. Use -O to overwrite")
+    check_options(args, sources, update)
+    if (args.dry_run):
+        dry_run(args, sources)
+        return
+    # Counts, grid geometry and mesh locators are only cached with --cache-dir
+    cache = CountsCache(args.cache_dir, int(args.cache_size * 1024**2)) if args.cache_dir else None
+    with stage("grid"):
+        if (grid_type == "map"):
+            grid = HorizontalGrid(topo_filename, resolution, mask_land, cache)
+        elif (grid_type == "profile"):
+            grid = VerticalGrid(topo_filename, resolution, depth_resolution, args.lat_band)
+        elif (grid_type == "volume"):
+            grid = VolumeGrid(topo_filename, resolution,
+                              depth_resolution, mask_land, cache)
+        elif (grid_type == "mesh"):
+            grid = UnstructuredGrid(topo_filename, cache)
+
+    # With -O an existing file is replaced on the first pass only
+    replace = overwrite or not result_file.exists
+    # One pool of worker processes for all time windows, files and passes
+    with worker_pool(args.workers) as pool:
+        while True:
+            try:
+                process_sources(args, grid, sources, update and not replace, cache, pool)
+                replace = False
+                # Release the particle files (the model may be writing them) and
+                # reopen them on the next pass to see the new time steps
+                for filename in sources:
+                    close_dataset(filename)
+                if (follow is None):
+                    break
+                # Poll the particle files for new time steps
+                time.sleep(follow)
+            except KeyboardInterrupt:
+                if (follow is None):
+                    raise
+                # An interrupted update is discarded, the results file has the
+                # counts of the last complete update
+                print("Stopped following")
+                break
+    return
+
+
+def process_sources(args, grid, sources, update, cache=None, pool=None):
+    """
+    Count the particle files and write the results file.
+    With update, only the time steps (and files) that are not in the results
+    file yet are counted and added to its counts. Counts are loaded from and
+    stored in the cache (CountsCache) if there is one. Workers are run in
+    pool (see worker_pool) if it is given.
+    """
+    result_filename = args.out_file
+    id_list = args.id_list
+    # TODO: Default should be a list of all options (loop and compute all)
+    sort_by = args.sort
+    ini_file = args.ini_file
+    last_positions = args.last
+    chunk_size = args.chunk_size
+    workers = args.workers
+    prefetch = args.prefetch
+    time_window = args.time_window
+    compact = args.compact
+    sparse_file = args.sparse_file
+    sparse = args.sparse or sparse_file
+    # Kernel density concentration of regular grids (bandwidth 0: off). It is
+    # dense, so with sparse counts it is only computed for a given bandwidth
+    smoothed = (grid.type in ("map", "volume") and args.bandwidth != 0
+                and (args.bandwidth is not None or not sparse))
+    # Connectivity and time statistics are counted in the same pass as the sort types
+    count_sorts = sort_by + ["connectivity"] if args.connectivity else sort_by
+    if (args.time_stats):
+        count_sorts = count_sorts + ["time"]
+    # Time statistics are written to the "all" group
+    groups = [sort_type for sort_type in count_sorts if sort_type != "time"]
+    if (args.time_stats and "all" not in groups):
+        groups = ["all"] + groups
+
+    result_file = ResultsFile(result_filename, sources)
+    previous_counts = None
+    previous_file = None
+    if (update and result_file.exists):
+        previous_file = result_file
+        result_file.read()
+        if (result_file.time is not None):
+            raise Exception("Time series results files can not be updated")
+        # The results file keeps its layout, layout options must match it
+        requested = "sparse" if sparse_file else "compact" if compact else None
+        if (requested is not None and requested != result_file.layout):
+            raise Exception(
+                f"Results file {result_filename} has the {result_file.layout} layout, not {requested}")
+        compact = result_file.layout == "compact"
+        sparse_file = result_file.layout == "sparse"
+        sparse = sparse or sparse_file
+        previous_sources = result_file.sources
+        processed = dict(zip(previous_sources, result_file.processed))
+        sources = previous_sources + [filename for filename in sources
+                                     if filename not in previous_sources]
+        starts = [processed.get(filename, 0) for filename in sources]
+        result_file = ResultsFile(result_filename, sources)
+    else:
+        starts = [0 for filename in sources]
+
+    dtype = "float32" if args.float32 else None
+    # Options that change the counts, part of the cache keys
+    cache_options = {"id_list": id_list, "float32": args.float32,
+                     "ini_file": None if ini_file is None else [ini_file, file_key(ini_file)]}
+    particle_files = [ParticleFile(filename, id_list, ini_file, i, dtype)
+                      for i, filename in enumerate(sources)]
+    particle_file = particle_files[0]
+    if (previous_file is not None):
+        # Previous counts are only read when there is something to add
+        if (all(pfile.ntime <= start for pfile, start in zip(particle_files, starts))):
+            print(f"No new time steps for {result_filename}")
+            return
+        previous_counts = read_previous_counts(previous_file, sort_by, grid.shape)
+        new_counts = count_new_steps(grid, particle_files, starts, sort_by,
+                                     chunk_size, workers, sparse, prefetch, pool)
+        windows = [(None, None)]
+    elif (time_window is None):
+        windows = [(0, None)]
+    else:
+        windows = particle_file.time_windows(time_window)
+    # Time steps in the results file, where the next update starts
+    result_file.processed = [pfile.ntime for pfile in particle_files]
+
+    # The results file is written to a partial file that replaces it when it
+    # is complete: an error or Ctrl-C keeps the previous results
+    try:
+        if (time_window is None):
+            result_file.initialize(grid, groups=groups, compact=compact,
+                                   sparse=sparse_file)
+        else:
+            time_units = f"seconds since {particle_file.time[0]:%Y-%m-%d %H:%M:%S}"
+            result_file.initialize(grid, groups=groups, time_units=time_units,
+                                   compact=compact, sparse=sparse_file)
+
+        OrdinaryCounter = Counts(grid)
+        ConcentrationCounter = Concentration(grid)
+        counters = [OrdinaryCounter, ConcentrationCounter]
+        if (smoothed):
+            counters.append(SmoothedConcentration(grid, args.bandwidth))
+        for start, stop in windows:
+            if (previous_counts is not None):
+                all_counts = {sort_type: merge_counts(grid.shape, previous_counts[sort_type], c)
+                              for sort_type, c in new_counts.items()}
+            else:
+                all_counts = cached_counts(cache, grid, particle_files, count_sorts, cache_options,
+                                           chunk_size, workers, start, stop, last_positions, sparse, prefetch, pool)
+            counts = {sort_type: {"counts": c, "name_dict": names}
+                      for sort_type, (c, names) in all_counts.items()}
+
+            # Compute measures
+            for sort_type in sort_by:
+                for counter in counters:
+                    with stage("quantities"):
+                        data = counter.run(counts[sort_type])
+                    with stage("write"):
+                        result_file.append(data, sort_type)
+
+            if ("time" in counts):
+                time_units = f"seconds since {particle_file.time[0]:%Y-%m-%d %H:%M:%S}"
+                for counter in (ResidenceTime(grid), ParticleAge(grid), ArrivalTime(grid, time_units)):
+                    with stage("quantities"):
+                        data = counter.run(counts["time"])
+                    with stage("write"):
+                        result_file.append(data, "all")
+
+            if ("connectivity" in counts):
+                for normalize in (False, True):
+                    with stage("quantities"):
+                        data = Connectivity(grid, normalize).run(
+                            counts["connectivity"])
+                    with stage("write"):
+                        result_file.append(data, "connectivity")
+
+            # Save results (each time window is written as soon as it is done)
+            with stage("write"):
+                if (time_window is None):
+                    result_file.write()
+                else:
+                    result_file.write(time=particle_file.time[start])
+        with stage("write"):
+            result_file.close()
+    except BaseException:
+        result_file.discard()
+        raise
+
+    return
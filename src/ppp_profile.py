@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class StageStats:
+    """Accumulated statistics of a pipeline stage"""
+
+    def __init__(self):
+        self.calls = 0
+        # Time without the time of nested stages, and with it
+        self.time = 0.
+        self.inclusive_time = 0.
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.positions = 0
+        self.peak_rss_mb = 0.
+
+    def to_dict(self):
+        return {"calls": self.calls,
+                "time": self.time,
+                "inclusive_time": self.inclusive_time,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "positions": self.positions,
+                "positions_per_second": self.positions / self.time if (self.positions and self.time > 0) else None,
+                "peak_rss_mb": self.peak_rss_mb}
+
+
+class _Stage:
+    """Context manager that times one call of a stage"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.t0 = None
+        self.nested = 0.
+
+    def __enter__(self):
+        self.profiler._active.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        self.profiler._active.pop()
+        if (self.profiler._active):
+            self.profiler._active[-1].nested += elapsed
+        self.profiler.stop(self.name, elapsed, self.nested)
+        return False
+
+
+class Profiler:
+    """
+    Records wall time, bytes read/written, positions processed and peak
+    memory of every stage of the pipeline.
+    Stages can be nested (e.g. reads within binning), the time of a stage
+    excludes the time of the stages nested in it. Every thread has its own
+    nesting, stages of background threads (prefetching reads) are added to
+    the same statistics.
+    Hooks are called with the stage name and the elapsed time every time a
+    stage is done. Stages of worker processes are merged in (see merge), so
+    stage times can add up to more than the wall time.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.hooks = []
+        self.t0 = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _active(self):
+        """Stages of the current thread that are running, innermost last"""
+        if (not hasattr(self._local, "active")):
+            self._local.active = []
+        return self._local.active
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def _stats(self, name):
+        if (name not in self.stages):
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def stop(self, name, elapsed, nested=0.):
+        with self._lock:
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.time += elapsed - nested
+            stats.inclusive_time += elapsed
+            stats.peak_rss_mb = max(stats.peak_rss_mb, peak_rss_mb())
+        for hook in self.hooks:
+            hook(name, elapsed)
+
+    def record(self, name, bytes_read=0, bytes_written=0, positions=0):
+        with self._lock:
+            stats = self._stats(name)
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+            stats.positions += positions
+
+    def merge(self, stages):
+        """Add the stage statistics of another profiler (e.g. of a worker process)"""
+        with self._lock:
+            for name, other in stages.items():
+                stats = self._stats(name)
+                stats.calls += other.calls
+                stats.time += other.time
+                stats.inclusive_time += other.inclusive_time
+                stats.bytes_read += other.bytes_read
+                stats.bytes_written += other.bytes_written
+                stats.positions += other.positions
+                stats.peak_rss_mb = max(stats.peak_rss_mb, other.peak_rss_mb)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def report(self):
+        """Report of all stages as a dictionary"""
+        return {"total_time": time.perf_counter() - self.t0,
+                "peak_rss_mb": peak_rss_mb(),
+                "stages": {name: stats.to_dict() for name, stats in self.stages.items()}}
+
+    def write(self, filename=None):
+        """Write the report as JSON to a file, or to stdout without a file name"""
+        report = json.dumps(self.report(), indent=2)
+        if (filename is None):
+            print(report)
+        else:
+            with open(filename, "w") as f:
+                f.write(report + "\n")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.**2 if sys.platform == "darwin" else rss / 1024.
+
+
+# Profiling is off unless enabled, stage() and record() then do nothing
+_profiler = None
+_null_stage = contextlib.nullcontext()
+
+
+def enable():
+    """Start profiling, returns the profiler"""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def profiler():
+    """Current profiler, None if profiling is off"""
+    return _profiler
+
+
+def stage(name):
+    """Context manager that times a stage (if profiling is on)"""
+    if (_profiler is None):
+        return _null_stage
+    return _profiler.stage(name)
+
+
+def record(name, bytes_read=0, bytes_written=0, positions=0):
+    """Add bytes and positions processed to a stage (if profiling is on)"""
+    if (_profiler is not None):
+        _profiler.record(name, bytes_read, bytes_written, positions)
+
+
+def merge(stages):
+    """Add the stage statistics of a worker process (if profiling is on)"""
+    if (_profiler is not None):
+        _profiler.merge(stages)
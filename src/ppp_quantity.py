@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+import numpy as np
+from .ppp_binning import SparseGroupedCounts
+from .ppp_profile import stage
+
 class Quantity:
     """
     Base class for quantities
@@ -11,6 +15,7 @@ class Quantity:
         self.name = None
         self.dims = None
         self.coords = None
+        self.dtype = "float32"
 
     def compute(self, counts):
         raise NotImplementedError("Quantity.compute not implemented")
@@ -22,9 +27,13 @@ class Quantity:
         # TODO: Here a long name could be added
         d["coords"] = self.coords
         d["dims"] = self.dims
-        # Name/value dictionary
+        d["dtype"] = self.dtype
+        # Group names (id/state), None for "all"
+        d["labels"] = name_dict
+        # Name/value dictionary of Python numbers, the repr of numpy scalars
+        # is not a plain number (numpy >= 2)
         nvd = {f"{self.name}{i}": val for i, val in enumerate(
-            name_dict)} if name_dict is not None else {f"{self.name}": "all"}
+            np.asarray(name_dict).tolist())} if name_dict is not None else {f"{self.name}": "all"}
         d["name_dict"] = nvd
         # if (len(nvd) != data.shape[0]):
         #     raise ValueError(
@@ -47,13 +56,198 @@ class Concentration(Quantity):
     def __init__(self, grid):
         super().__init__()
         self.grid = grid
-        self.units = "particles/m2"
+        self.units = "particles/m3" if grid.type == "volume" else "particles/m2"
         self.name = "concentration"
         self.dims = grid.dims
         self.coords = grid.coords
 
     def compute(self, counts):
-        return counts/self.grid.cell_area
+        # Cells below the sea floor have no volume, concentration is undefined
+        cell_size = self.grid.cell_size
+        if (isinstance(counts, SparseGroupedCounts)):
+            # Only occupied cells are divided, empty cells keep the background
+            cell_size = np.broadcast_to(cell_size, counts.grid_shape)
+            size = cell_size.ravel()[counts.keys % counts.shape[1]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.where(size > 0, counts.data/size, np.nan)
+            return counts.with_data(values, np.where(cell_size > 0, 0., np.nan))
+        # Divided into a single array of the output type, cells without size
+        # keep the NaN background
+        concentration = np.full(np.shape(counts), np.nan, dtype=self.dtype)
+        np.divide(counts, cell_size, out=concentration, where=cell_size > 0)
+        return concentration
+
+
+class SmoothedConcentration(Concentration):
+    """
+    Class to compute a kernel density concentration: the counts are
+    smoothed with a Gaussian kernel (bandwidth = standard deviation in
+    meters) before they are divided by the cell size. Only horizontal axes
+    are smoothed.
+    Counts below the sea floor of a volume grid are first moved up to the
+    deepest sea cell of their water column (to the surface on land). The kernel of every cell is
+    renormalized over the sea cells, so no particles are moved onto land
+    (or below the sea floor). The total count is kept, except for counts
+    of cells with no sea within their kernel (about five bandwidths), which
+    are dropped.
+    The convolution is done by FFT, several layers per transform.
+    Without a bandwidth it is twice the mean cell size.
+    """
+
+    # Number of grid cells transformed at once (all layers of a batch)
+    batch_size = 1 << 22
+
+    def __init__(self, grid, bandwidth=None):
+        super().__init__(grid)
+        self.name = "smoothed_concentration"
+        # Default: twice the mean cell size
+        if (bandwidth is None):
+            bandwidth = 2. * np.sqrt(np.nanmean(grid.dx * grid.dy))
+        self.bandwidth = bandwidth
+        # Cells per standard deviation along lat and lon
+        self.sigma = (bandwidth / np.nanmean(grid.dy), bandwidth / np.nanmean(grid.dx))
+        wet = np.broadcast_to(grid.cell_size > 0, grid.shape)
+        sea = wet & ~np.broadcast_to(grid.landmask(), grid.shape)
+        self.sea = sea.astype(float)
+        # Cells below the sea floor and the deepest sea cell of their column
+        # (the surface cell of columns without sea)
+        self.below, self.bottom = None, None
+        if (grid.type == "volume"):
+            level = np.arange(grid.shape[0])[:, np.newaxis, np.newaxis]
+            floor = np.maximum(wet.sum(axis=0) - 1, 0)
+            self.below = level > floor
+            self.bottom = level == floor
+        # Weight of every cell: one over the part of its kernel that is at sea
+        norm = self._smooth(self.sea[np.newaxis])[0]
+        with np.errstate(divide="ignore"):
+            self.weight = np.where(norm > 1.e-6, 1./norm, 0.)
+
+    def _smooth(self, data):
+        """Gaussian filter of the last two axes of a batch of layers, a single transform"""
+        ny, nx = data.shape[-2:]
+        # Zero padding of five standard deviations, no wrap-around
+        shape = (_fft_size(ny + int(np.ceil(5*self.sigma[0]))),
+                 _fft_size(nx + int(np.ceil(5*self.sigma[1]))))
+        fy = np.fft.fftfreq(shape[0])[:, np.newaxis]
+        fx = np.fft.rfftfreq(shape[1])[np.newaxis, :]
+        # Fourier transform of the Gaussian kernel
+        kernel = np.exp(-2.*np.pi**2 * ((self.sigma[0]*fy)**2 + (self.sigma[1]*fx)**2))
+        spectrum = np.fft.rfft2(data, s=shape, axes=(-2, -1))
+        spectrum *= kernel
+        return np.fft.irfft2(spectrum, s=shape, axes=(-2, -1))[..., :ny, :nx]
+
+    def _to_sea_floor(self, layers, window):
+        """Counts of a batch of layers with counts below the sea floor moved up"""
+        if (self.below is None):
+            return layers
+        below, bottom = self.below[window], self.bottom[window]
+        moved = np.where(below, layers, 0).sum(axis=-3, keepdims=True)
+        return np.where(below, 0, layers) + bottom * moved
+
+    def smooth(self, counts):
+        """Smoothed counts, a dense array of the same shape as the counts"""
+        if (isinstance(counts, SparseGroupedCounts)):
+            nlayers = counts.shape[0]
+            grouped = counts.labels is not None
+        else:
+            counts = np.asarray(counts)
+            grouped = counts.ndim > len(self.grid.shape)
+            nlayers = counts.shape[0] if grouped else 1
+        smoothed = np.zeros((nlayers,) + self.grid.shape, dtype=self.dtype)
+        nbatch = max(self.batch_size // int(np.prod(self.grid.shape)), 1)
+        ny, nx = self.grid.shape[-2:]
+        pad = (int(np.ceil(5*self.sigma[0])), int(np.ceil(5*self.sigma[1])))
+        for l0 in range(0, nlayers, nbatch):
+            l1 = min(l0 + nbatch, nlayers)
+            if (isinstance(counts, SparseGroupedCounts)):
+                layers = np.stack([counts.layer(i) for i in range(l0, l1)])
+            else:
+                layers = counts[l0:l1] if grouped else counts[np.newaxis]
+            # Only the part of the grid around the particles is transformed
+            occupied = layers != 0
+            rows = np.flatnonzero(occupied.any(axis=-1).reshape(-1, ny).any(axis=0))
+            cols = np.flatnonzero(occupied.any(axis=-2).reshape(-1, nx).any(axis=0))
+            if (len(rows) == 0):
+                continue
+            y0, y1 = max(rows[0] - pad[0], 0), min(rows[-1] + pad[0] + 1, ny)
+            x0, x1 = max(cols[0] - pad[1], 0), min(cols[-1] + pad[1] + 1, nx)
+            window = (Ellipsis, slice(y0, y1), slice(x0, x1))
+            layers = self._to_sea_floor(layers[window], window)
+            values = self._smooth(layers * self.weight[window])
+            # Rounding errors of the transform can be slightly negative
+            smoothed[l0:l1][window] = self.sea[window] * np.maximum(values, 0.)
+        return smoothed if grouped else smoothed[0]
+
+    def compute(self, counts):
+        with stage("smooth"):
+            smoothed = self.smooth(counts)
+        return super().compute(smoothed)
+
+
+def _fft_size(n):
+    """Smallest size >= n without prime factors larger than 5 (fast FFT)"""
+    size = n
+    while (True):
+        m = size
+        for p in (2, 3, 5):
+            while (m % p == 0):
+                m //= p
+        if (m == 1):
+            return size
+        size += 1
+
+
+class ResidenceTime(Quantity):
+    """
+    Class to compute the mean residence time: the mean time a particle
+    stays in a cell from entering it until it leaves (or stops)
+    """
+
+    def __init__(self, grid):
+        super().__init__()
+        self.grid = grid
+        self.units = "s"
+        self.name = "residence_time"
+        self.dims = grid.dims
+        self.coords = grid.coords
+
+    def compute(self, counts):
+        return counts.residence_time()
+
+
+class ParticleAge(Quantity):
+    """
+    Class to compute the mean age (time since release) of the particles
+    in a cell
+    """
+
+    def __init__(self, grid):
+        super().__init__()
+        self.grid = grid
+        self.units = "s"
+        self.name = "age"
+        self.dims = grid.dims
+        self.coords = grid.coords
+
+    def compute(self, counts):
+        return counts.mean_age()
+
+
+class ArrivalTime(Quantity):
+    """
+    Class to compute the time the first particle arrives in a cell
+    """
+
+    def __init__(self, grid, time_units="seconds since first time step"):
+        super().__init__()
+        self.grid = grid
+        self.units = time_units
+        self.name = "arrival_time"
+        self.dims = grid.dims
+        self.coords = grid.coords
+
+    def compute(self, counts):
+        return counts.arrival_time()
 
 
 class Counts(Quantity):
@@ -68,6 +262,40 @@ class Counts(Quantity):
         self.name = "counts"
         self.dims = grid.dims
         self.coords = grid.coords
+        self.dtype = "int32"
 
     def compute(self, counts):
         return counts
+
+
+class Connectivity(Quantity):
+    """
+    Class to compute the source-destination connectivity matrix.
+    The matrix is sparse: counts are (source cell, destination cell, count)
+    arrays of the nonzero entries. The probability is the count divided by
+    the total count of the source cell.
+    """
+
+    def __init__(self, grid, normalize=True):
+        super().__init__()
+        self.grid = grid
+        self.normalize = normalize
+        self.units = "1" if normalize else "particles"
+        self.name = "probability" if normalize else "counts"
+        self.dims = grid.dims
+        self.coords = grid.coords
+        self.dtype = "float32" if normalize else "int32"
+
+    def compute(self, counts):
+        source, destination, values = counts
+        if (not self.normalize):
+            return values
+        total = np.bincount(source, weights=values)
+        return values / total[source]
+
+    def run(self, counts):
+        data = self.data_to_dict(self.compute(counts["counts"]), None)
+        # Flat (row-major) cell indices of the nonzero entries
+        source, destination = counts["counts"][:2]
+        data["sparse"] = {"source": source, "destination": destination}
+        return data
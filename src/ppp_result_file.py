@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import ast
 import os
-from .ppp_nc_funcs import get_file_attributes, get_dimensions
+from collections import OrderedDict
+from .ppp_nc_funcs import get_dimensions, open_dataset, close_dataset
+from .ppp_binning import SparseGroupedCounts
+from .ppp_profile import record
 import numpy as np
-from netCDF4 import Dataset
+from netCDF4 import Dataset, date2num
 
 
 class ResultsFile:
@@ -11,26 +15,59 @@ class ResultsFile:
     File class to store results
     """
 
+    # Number of hyperslabs kept in memory by get()
+    cache_size = 32
+
     def __init__(self, filename, original_file):
         self.filename = filename
+        # Particle file name, or list of names for an ensemble
         self.original_file = original_file
+        self.sources = list(original_file) if isinstance(
+            original_file, (list, tuple)) else [original_file]
+        # Number of time steps of every source that are in the file
+        self.processed = None
         self.lon = None
         self.lat = None
         self.depth = None
         self.dims = None
         self.coords = None
         self.type = None
-        # Outgoing data
-        self.data = None
+        self.groups = None
+        self.compact = False
+        self.sparse = False
+        self._ncout = None
+        # Time series output
+        self.time_units = None
+        self._itime = None
+        self._layers = {}
+        self._quantities = {}
+        self._written = set()
+        self._ngroups_previous = {}
         self.exists = os.path.exists(filename)
         if (self.exists):
             self.check_dimensions()
 
-    def initialize(self, grid, groups):
+    def initialize(self, grid, groups, time_units=None, compact=False, sparse=False):
+        """
+        Create the results file.
+        With time_units the file gets an unlimited time dimension and every
+        call to write() appends one time step (window).
+        With compact, every quantity of a group is stored in a single
+        compressed variable with a group dimension (id/state) and the group
+        names as a coordinate variable, instead of one variable per layer.
+        With sparse, only the occupied cells of sparse counts are stored, as
+        (layer, cell, value) entries.
+        """
+        if (sparse and time_units is not None):
+            raise Exception("Sparse results can not be written as a time series")
         self.type = grid.type
         self.dims = grid.dims
         self.coords = grid.coords
-        self.data = {group: [] for group in groups}
+        self.groups = list(groups)
+        self.time_units = time_units
+        self.compact = compact
+        self.sparse = sparse
+        self._itime = 0
 
         # Check that the dimensions and coordinates are the same
         for dimname, dimsize in self.dims.items():
@@ -41,85 +78,549 @@ class ResultsFile:
                 raise Exception(
                     f"Results file has dimension {dimname} with wrong size")
 
-        # Create the file
+        # Create the file (and keep it open until everything is written).
+        # It is written as a partial file that replaces the results file when
+        # it is closed, until then an existing results file is kept
         print(f"Creating results file {self.filename}")
-        ncout = Dataset(self.filename, "w", format="NETCDF4")
+        ncout = Dataset(self.partial_filename, "w", format="NETCDF4")
         for dimname, dimsize in self.dims.items():
             ncout.createDimension(dimname, dimsize)
         for varname, var in self.coords.items():
             ncout.createVariable(varname, "float32", (varname,))
             ncout.variables[varname][:] = var
+        for varname, (dims, var) in grid.aux_coords.items():
+            ncout.createVariable(varname, "float32", dims)
+            ncout.variables[varname][:] = var
+        if (sparse):
+            # Cells with an area (volume), the others have no concentration
+            sea = ncout.createVariable("sea", "i1", tuple(self.dims),
+                                       zlib=True, shuffle=True, complevel=4)
+            sea.setncatts({"long_name": "1 where the cell has an area (volume), "
+                           "empty cells of quantities with a sea background are NaN elsewhere"})
+            with np.errstate(invalid="ignore"):
+                sea[:] = np.broadcast_to(grid.cell_size > 0, grid.shape)
+        if (time_units is not None):
+            ncout.createDimension("time", None)
+            ncout.createVariable("time", "float64", ("time",))
+            ncout.variables["time"].setncatts({"units": time_units,
+                                               "calendar": "standard"})
         # Set global attributes
-        ncout.setncatts({"original_file": self.original_file,
-                         "type": self.type})
-        ncout.close()
+        ncout.setncatts({"original_file": ", ".join(self.sources),
+                         "sources": str(self.sources),
+                         "processed": str(self.processed),
+                         "type": self.type,
+                         "layout": "sparse" if sparse else "compact" if compact else "layers"})
+        self._ncout = ncout
 
     def append(self, data, group):
-        """Append data dictionary to outgoing data"""
-        self.data[group].append(data)
-
-    def write(self):
-        print(f"Writing results to file {self.filename}")
-        ncout = Dataset(self.filename, "a", format="NETCDF4")
-        for data_group in self.data.keys():
-            for data_item in self.data[data_group]:
-                # Check that the dimensions and coordinates are the same
-                for dimname in self.dims.keys():
-                    if (dimname not in data_item["dims"]):
-                        raise Exception(
-                            f"Results file has dimension {dimname} that is not in data")
-                # Create the variable
-                for i_layer, (varname, varval) in enumerate(data_item["name_dict"].items()):
-                    full_varname = f"{data_group}_{varname}"
-                    ncout.createVariable(
-                        full_varname, "float32", tuple(data_item["dims"].keys()))
-                    # Write the data
-                    if (data_item["data"].ndim == 3):
-                        ncout.variables[full_varname][:] = data_item["data"][i_layer, :, :]
-                    else:
-                        ncout.variables[full_varname][:] = data_item["data"]
-                    # Add attributes
-                    ncout.variables[full_varname].setncatts(data_item["attrs"])
+        """Write data dictionary of a group to the file"""
+        if (group not in self.groups):
+            raise Exception(f"Results file has no group {group}")
+        ncout = self._ncout
+        if (ncout is None):
+            close_dataset(self.filename)
+            ncout = Dataset(self.filename, "a", format="NETCDF4")
+            self._ncout = ncout
+        # Check that the dimensions and coordinates are the same
+        for dimname in self.dims.keys():
+            if (dimname not in data["dims"]):
+                raise Exception(
+                    f"Results file has dimension {dimname} that is not in data")
+        if (self.time_units is not None):
+            self._quantities.setdefault(group, set()).add(data["name"])
+        if ("sparse" in data):
+            self._write_sparse(ncout, data, group, data["sparse"])
+        elif (self.sparse):
+            values = data["data"]
+            if (not isinstance(values, SparseGroupedCounts)):
+                raise Exception("Sparse results files need sparse counts")
+            layer, cell = np.divmod(values.keys, values.shape[1])
+            self._write_sparse(ncout, data, group, {"layer": layer, "cell": cell},
+                               values.data, values.background)
+        elif (self.compact):
+            self._write_compact(ncout, data, group)
+        else:
+            self._write_layers(ncout, data, group)
+
+    def _write_layers(self, ncout, data, group):
+        """Write every layer as a separate variable"""
+        time_series = self.time_units is not None
+        itime = self._itime
+        dims = tuple(data["dims"].keys())
+        if (time_series):
+            dims = ("time",) + dims
+        # Create the variable
+        for i_layer, (varname, varval) in enumerate(data["name_dict"].items()):
+            if (time_series and data["labels"] is not None):
+                # Layers are matched by name (id/state) between time steps
+                varname = f"{data['name']}{self._layer_index(group, varval)}"
+            full_varname = f"{group}_{varname}"
+            if (full_varname not in ncout.variables):
+                # Counts are stored as integers (exact when they are updated)
+                ncout.createVariable(full_varname, data["dtype"], dims)
+                if (time_series and itime > 0):
+                    ncout.variables[full_varname][:itime] = 0.
+            self._written.add(full_varname)
+            # Write the data
+            if (is_layer_source(data["data"])):
+                layer = data["data"].layer(i_layer)
+            elif (data["labels"] is not None):
+                layer = data["data"][i_layer]
+            else:
+                layer = data["data"]
+            if (time_series):
+                ncout.variables[full_varname][itime] = layer
+            else:
+                ncout.variables[full_varname][:] = layer
+            # Add attributes, the label (id/state) is stored as a number
+            ncout.variables[full_varname].setncatts(data["attrs"])
+            if (data["labels"] is not None):
+                ncout.variables[full_varname].setncatts({"label": varval})
+
+    def _write_compact(self, ncout, data, group):
+        """Write all layers into one compressed variable with a group dimension"""
+        time_series = self.time_units is not None
+        itime = self._itime
+        full_varname = f"{group}_{data['name']}"
+        spatial_dims = tuple(data["dims"].keys())
+        spatial_shape = tuple(data["dims"].values())
+        values = data["data"]
+        labels = data["labels"]
+
+        dims = spatial_dims
+        chunks = spatial_shape
+        index = None
+        if (labels is not None):
+            if (group not in ncout.dimensions):
+                # Group names are only known in full at the end of a time series
+                ncout.createDimension(
+                    group, None if time_series else len(labels))
+                ncout.createVariable(group, np.asarray(labels).dtype, (group,))
+            if (time_series):
+                index = [self._layer_index(group, val) for val in labels]
+                ncout.variables[group][index] = np.asarray(labels)
+            else:
+                index = slice(None)
+                ncout.variables[group][:] = np.asarray(labels)
+            dims = (group,) + dims
+            chunks = (1,) + chunks
+        if (time_series):
+            dims = ("time",) + dims
+            chunks = (1,) + chunks
+
+        if (full_varname not in ncout.variables):
+            ncout.createVariable(full_varname, data["dtype"], dims, zlib=True,
+                                 shuffle=True, complevel=4, chunksizes=chunks)
+            attrs = {key: val for key,
+                     val in data["attrs"].items() if key != "name_dict"}
+            ncout.variables[full_varname].setncatts(attrs)
+        var = ncout.variables[full_varname]
+        if (is_layer_source(values)):
+            # Written layer by layer, the dense array is never in memory
+            self._write_compact_layers(var, values, labels, group, index)
+            return
+        values = np.asarray(values).astype(data["dtype"])
+        if (not time_series):
+            var[:] = values
+            return
+        if (labels is None):
+            var[itime] = values
+            return
+        # Groups missing from this time step are zero, as are new groups at
+        # the earlier time steps
+        ngroups = len(self._layers[group])
+        step = np.zeros((ngroups,) + spatial_shape, dtype=data["dtype"])
+        step[index] = values
+        var[itime, :ngroups] = step
+        nprevious = self._ngroups_previous.get(group, 0)
+        if (itime > 0 and ngroups > nprevious):
+            var[:itime, nprevious:ngroups] = 0
+
+    def _write_compact_layers(self, var, values, labels, group, index):
+        """
+        Write a layer source (see is_layer_source) into a compact variable,
+        one layer at a time
+        """
+        if (labels is None):
+            if (self.time_units is None):
+                var[:] = values.layer(0)
+            else:
+                var[self._itime] = values.layer(0)
+            return
+        if (self.time_units is None):
+            for i in range(values.shape[0]):
+                var[i] = values.layer(i)
+            return
+        # Groups missing from this time step are zero, as are new groups at
+        # the earlier time steps
+        ngroups = len(self._layers[group])
+        present = dict(zip(index, range(len(index))))
+        for i in range(ngroups):
+            if (i in present):
+                var[self._itime, i] = values.layer(present[i])
+            else:
+                var[self._itime, i] = 0
+        nprevious = self._ngroups_previous.get(group, 0)
+        if (self._itime > 0 and ngroups > nprevious):
+            var[:self._itime, nprevious:ngroups] = 0
+
+    def _write_sparse(self, ncout, data, group, index, values=None, background=0):
+        """
+        Write sparse data as entries along a {group}_nnz dimension: index is a
+        dictionary of index arrays (e.g. source and destination cell, or
+        layer and cell), values default to the data.
+        Cells without entries are zero, with a background that is NaN outside
+        the sea (concentration) they are NaN where the "sea" variable is 0.
+        """
+        if (self.time_units is not None):
+            raise Exception("Sparse quantities can not be written as a time series")
+        if (values is None):
+            values = data["data"]
+        dimname = f"{group}_nnz"
+        if (dimname not in ncout.dimensions):
+            ncout.createDimension(dimname, len(values))
+            for varname, indices in index.items():
+                var = ncout.createVariable(f"{group}_{varname}", "int32", (dimname,),
+                                           zlib=True, shuffle=True, complevel=4)
+                if (varname == "layer"):
+                    var.setncatts({"long_name": f"layer (index of the {group} coordinate)"})
+                else:
+                    var.setncatts({"long_name": f"{varname} cell (flat row-major index of the {', '.join(self.dims)} grid)"})
+                var[:] = indices
+        if (data["labels"] is not None and group not in ncout.variables):
+            labels = np.asarray(data["labels"])
+            ncout.createDimension(group, len(labels))
+            ncout.createVariable(group, labels.dtype, (group,))
+            ncout.variables[group][:] = labels
+        full_varname = f"{group}_{data['name']}"
+        var = ncout.createVariable(full_varname, data["dtype"], (dimname,),
+                                   zlib=True, shuffle=True, complevel=4)
+        attrs = {key: val for key,
+                 val in data["attrs"].items() if key != "name_dict"}
+        attrs["layout"] = "sparse"
+        if (np.isnan(background).any()):
+            attrs["background"] = "sea"
+        var.setncatts(attrs)
+        var[:] = np.asarray(values).astype(data["dtype"])
+
+    def write(self, time=None):
+        """
+        Finish writing.
+        If time is given, the data appended so far is the next step of the
+        time series and the file is kept open until close() is called.
+        """
+        if (time is not None):
+            print(f"Writing results to file {self.filename} ({time})")
+            ncout = self._ncout
+            ncout.variables["time"][self._itime] = date2num(
+                time, self.time_units)
+            # Layers that had no data in this time step are zero
+            for group, qnames in self._quantities.items():
+                if (self.compact):
+                    continue
+                for qname in qnames:
+                    for i in range(len(self._layers.get(group, []))):
+                        varname = f"{group}_{qname}{i}"
+                        if (varname not in self._written):
+                            ncout.variables[varname][self._itime] = 0.
+            self._written = set()
+            self._ngroups_previous = {group: len(layers)
+                                      for group, layers in self._layers.items()}
+            self._itime += 1
+            self._ncout.sync()
+        else:
+            print(f"Writing results to file {self.filename}")
+            self.close()
+
+    def _layer_index(self, group, name):
+        """Index of a named layer in the time series, new names are added at the end"""
+        layers = self._layers.setdefault(group, [])
+        if (name not in layers):
+            layers.append(name)
+        return layers.index(name)
+
+    def close(self):
+        """
+        Close the file.
+        Layers of a time series are renamed so that they are sorted by name,
+        as in the time-integrated output.
+        """
+        if (self._ncout is None):
+            return
+        ncout = self._ncout
+        for group, layers in self._layers.items():
+            if (self.compact):
+                # Group names are stored in a coordinate variable
+                continue
+            order = np.argsort(layers, kind="stable")
+            sorted_layers = [layers[i] for i in order]
+            for qname in self._quantities[group]:
+                if (np.any(order != np.arange(len(order)))):
+                    # Rename in two steps, the new names are taken by other layers
+                    for i_old in range(len(layers)):
+                        ncout.renameVariable(f"{group}_{qname}{i_old}",
+                                             f"{group}_{qname}{i_old}_tmp")
+                    for i_new, i_old in enumerate(order):
+                        ncout.renameVariable(f"{group}_{qname}{i_old}_tmp",
+                                             f"{group}_{qname}{i_new}")
+                nvd = {f"{qname}{i}": val for i,
+                       val in enumerate(sorted_layers)}
+                for i in range(len(layers)):
+                    ncout.variables[f"{group}_{qname}{i}"].setncatts(
+                        {"name_dict": str(nvd)})
         ncout.close()
+        if (os.path.exists(self.partial_filename)):
+            close_dataset(self.filename)
+            os.replace(self.partial_filename, self.filename)
+        record("write", bytes_written=os.path.getsize(self.filename))
+        self._ncout = None
+        self._layers = {}
+        self._quantities = {}
+        self._written = set()
+        self._ngroups_previous = {}
+
+    @property
+    def partial_filename(self):
+        """File that is written until the results are complete"""
+        return f"{self.filename}.part"
+
+    def discard(self):
+        """Close the file without replacing the results file, e.g. after an error"""
+        if (self._ncout is not None):
+            try:
+                self._ncout.close()
+            except Exception:
+                pass
+            self._ncout = None
+        if (os.path.exists(self.partial_filename)):
+            os.remove(self.partial_filename)
 
     def check_dimensions(self):
         """
         Get dimensions of file
         """
         self.dims = get_dimensions(self.filename)
-        if (len(self.dims) != 2):
+        # Time series have a time dimension, compact files have group
+        # dimensions and sparse quantities a {group}_nnz dimension
+        spatial_dims = set(dimname for dimname in self.dims
+                           if not dimname.endswith("_nnz")).difference(
+            ["time", "id", "state", "member"])
+        if (len(spatial_dims) not in (1, 2, 3)):
             raise Exception("Results file has wrong number of dimensions")
-        if (len(set(self.dims).intersection(["lon", "lat", "depth"])) != 2):
+        if (spatial_dims == {"cell"}):
+            return
+        if (len(spatial_dims.intersection(["lon", "lat", "depth"])) != len(spatial_dims)):
             raise Exception(f"Results file has wrong dimensions: {self.dims}")
 
     def read(self):
         """
-        Read results from file
-        """
-        with Dataset(self.filename) as f:
-            self.type = get_file_attributes(self.filename, "type")
-            if (self.type == "map"):
-                self.lon = np.array(f.variables["lon"][:])
-                self.lat = np.array(f.variables["lat"][:])
-            elif (self.type == "profile"):
-                # TODO: Should be able to have a profile that is not just along the GOF thalweg
-                self.depth = np.array(f.variables["depth"][:])
-                self.lon = np.array(f.variables["lon"][:])
-            countvars = []
-            concvars = []
-            for vname in f.variables.keys():
-                if (vname.__contains__("counts")):
-                    countvars.append(vname)
-                if (vname.__contains__("concentration")):
-                    concvars.append(vname)
-            self.ncounts = len(countvars)
-            self.nconcentration = len(concvars)
-            counts = [[]]*self.ncounts
-            concentration = [[]]*self.nconcentration
-            for ivar, vname in enumerate(countvars):
-                counts[ivar] = np.array(f.variables[vname][:])
-            for ivar, vname in enumerate(concvars):
-                concentration[ivar] = np.array(
-                    f.variables[vname][:])
-            self.counts = np.array(counts)
-            self.concentration = np.array(concentration)
+        Read results file metadata.
+        Only coordinates and the list of stored quantities are read, the data
+        itself is read on demand with get().
+        """
+        f = open_dataset(self.filename)
+        self.type = f.getncattr("type")
+        self.layout = f.getncattr(
+            "layout") if "layout" in f.ncattrs() else "layers"
+        if (self.type == "map"):
+            self.lon = np.array(f.variables["lon"][:])
+            self.lat = np.array(f.variables["lat"][:])
+        elif (self.type == "profile"):
+            # TODO: Should be able to have a profile that is not just along the GOF thalweg
+            self.depth = np.array(f.variables["depth"][:])
+            self.lon = np.array(f.variables["lon"][:])
+        elif (self.type == "mesh"):
+            self.lon = np.array(f.variables["lonc"][:])
+            self.lat = np.array(f.variables["latc"][:])
+        elif (self.type == "volume"):
+            self.depth = np.array(f.variables["depth"][:])
+            self.lon = np.array(f.variables["lon"][:])
+            self.lat = np.array(f.variables["lat"][:])
+        self.time = np.array(
+            f.variables["time"][:]) if "time" in f.variables else None
+        self.time_units = f.variables["time"].units if "time" in f.variables else None
+        self.sources = ast.literal_eval(f.getncattr("sources")) if "sources" in f.ncattrs() else [
+            f.getncattr("original_file")]
+        # Files without the attribute are taken as completely processed
+        self.processed = ast.literal_eval(f.getncattr("processed")) if "processed" in f.ncattrs() else None
+        if (self.processed is None):
+            self.processed = [np.iinfo(np.int64).max for source in self.sources]
+
+        # Index of stored quantities: (group, quantity) -> variable names
+        self._vars = {}
+        self._labels = {}
+        self._sparse = set()
+        for vname, var in f.variables.items():
+            if ("name" not in var.ncattrs()):
+                continue
+            qname = var.getncattr("name")
+            group = vname.split("_")[0]
+            if ("layout" in var.ncattrs() and var.getncattr("layout") == "sparse"):
+                self._sparse.add((group, qname))
+                if (f"{group}_cell" not in f.variables):
+                    # Not a grid quantity (e.g. connectivity), see get_sparse()
+                    continue
+            self._vars.setdefault((group, qname), []).append(vname)
+            if (group in self._labels):
+                continue
+            if (self.layout in ("compact", "sparse")):
+                self._labels[group] = np.array(
+                    f.variables[group][:]) if group in f.variables else None
+            elif (group == "all"):
+                self._labels[group] = None
+            elif ("label" not in var.ncattrs()):
+                # Files written before labels were stored as numbers
+                nvd = ast.literal_eval(var.getncattr("name_dict"))
+                self._labels[group] = np.array(list(nvd.values()))
+        if (self.layout == "layers"):
+            # Layer variables in layer order
+            for key, vnames in self._vars.items():
+                prefix = len(f"{key[0]}_{key[1]}")
+                vnames.sort(key=lambda vname: int(vname[prefix:] or 0))
+                if (key[0] not in self._labels):
+                    self._labels[key[0]] = np.array(
+                        [f.variables[vname].getncattr("label") for vname in vnames])
+        self.ncounts = sum(self.nlayers(group) for group, qname in self._vars
+                           if qname == "counts")
+        self.nconcentration = sum(self.nlayers(group) for group, qname in self._vars
+                                  if qname == "concentration")
+        self._cache = OrderedDict()
+
+    def get_sparse(self, group, quantity):
+        """Sparse quantity as (source cell, destination cell, value) arrays"""
+        if ((group, quantity) not in self._sparse):
+            raise Exception(f"Results file has no sparse {group} {quantity}")
+        f = open_dataset(self.filename)
+        return tuple(np.array(f.variables[f"{group}_{vname}"][:])
+                     for vname in ("source", "destination", quantity))
+
+    @property
+    def quantities(self):
+        """List of stored (group, quantity) pairs"""
+        return list(self._vars.keys())
+
+    def labels(self, group):
+        """Names (id/state values) of the layers of a group, None for all"""
+        return self._labels[group]
+
+    def nlayers(self, group):
+        labels = self._labels[group]
+        return 1 if labels is None else len(labels)
+
+    def get(self, group, quantity, layer=None, label=None, time=None, **window):
+        """
+        Read a hyperslab of a quantity.
+        layer selects layers by index (int, slice or list), label by id/state
+        value; time selects time steps of a time series; the spatial window is
+        given with slices per dimension, e.g. lat=slice(10, 20).
+        Selections given as int drop that axis. The result has axes
+        (time, layer, *spatial) and is cached; it must not be modified.
+        """
+        if (label is not None):
+            labels = list(self._labels[group])
+            layer = [labels.index(val) for val in label] if np.ndim(
+                label) else labels.index(label)
+        key = (group, quantity, _index_key(layer), _index_key(time)) + tuple(
+            (dimname, _index_key(sel)) for dimname, sel in sorted(window.items()))
+        if (key in self._cache):
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        f = open_dataset(self.filename)
+        vnames = self._vars[(group, quantity)]
+        spatial = tuple(window.get(dimname, slice(None))
+                        for dimname in f.variables[vnames[0]].dimensions
+                        if dimname not in ("time", group))
+        tsel = () if self.time is None else (
+            slice(None) if time is None else time,)
+        if ((group, quantity) in self._sparse):
+            spatial = tuple(window.get(dimname, slice(None))
+                            for dimname in f.dimensions if dimname in ("depth", "lat", "lon", "cell"))
+            lsel = 0 if self._labels[group] is None else slice(
+                None) if layer is None else layer
+            data = self._read_sparse_layers(f, group, quantity, lsel)[
+                (lsel,) + spatial]
+        elif (self._labels[group] is None):
+            data = np.array(f.variables[vnames[0]][tsel + spatial])
+        elif (self.layout == "compact"):
+            lsel = slice(None) if layer is None else layer
+            data = np.array(f.variables[vnames[0]][tsel + (lsel,) + spatial])
+        else:
+            indices = np.arange(len(self._labels[group]))[
+                slice(None) if layer is None else layer]
+            layers = [np.array(f.variables[vnames[i]][tsel + spatial])
+                      for i in np.atleast_1d(indices)]
+            if (np.ndim(indices) == 0):
+                data = layers[0]
+            else:
+                # Layer axis goes after the time axis (if it was not dropped)
+                time_axis = len(tsel) > 0 and (
+                    isinstance(tsel[0], slice) or np.ndim(tsel[0]) > 0)
+                data = np.stack(layers, axis=1 if time_axis else 0)
+        data.flags.writeable = False
+
+        self._cache[key] = data
+        while (len(self._cache) > self.cache_size):
+            self._cache.popitem(last=False)
+        return data
+
+    def _read_sparse_layers(self, f, group, quantity, layer):
+        """
+        Dense (nlayers, *spatial) array of a sparse quantity, only the layers
+        selected by layer are filled in. Cells without entries are zero, or
+        NaN outside the sea for quantities with a sea background.
+        """
+        shape = tuple(len(f.dimensions[dimname]) for dimname in f.dimensions
+                      if dimname in ("depth", "lat", "lon", "cell"))
+        nlayers = self.nlayers(group)
+        selected = np.zeros(nlayers, dtype=bool)
+        selected[layer] = True
+        index = np.array(f.variables[f"{group}_layer"][:]) if f"{group}_layer" in f.variables else np.zeros(
+            len(f.dimensions[f"{group}_nnz"]), dtype=int)
+        entries = np.flatnonzero(selected[index])
+        cells = np.array(f.variables[f"{group}_cell"][:])[entries]
+        values = np.array(f.variables[f"{group}_{quantity}"][:])[entries]
+        data = np.zeros((nlayers, int(np.prod(shape))), dtype=values.dtype)
+        data[index[entries], cells] = values
+        var = f.variables[f"{group}_{quantity}"]
+        if ("background" in var.ncattrs() and var.getncattr("background") == "sea"):
+            data[:, np.array(f.variables["sea"][:]).ravel() == 0] = np.nan
+        return data.reshape((nlayers,) + shape)
+
+    def _stack(self, quantity):
+        """All layers of all groups of a quantity, stacked along the layer axis"""
+        layers = []
+        for group, qname in self._vars:
+            if (qname != quantity):
+                continue
+            data = self.get(group, qname)
+            if (self._labels[group] is None):
+                data = np.expand_dims(data, 0 if self.time is None else 1)
+            layers.append(data)
+        return np.concatenate(layers, axis=0 if self.time is None else 1)
+
+    @property
+    def counts(self):
+        return self._stack("counts")
+
+    @property
+    def concentration(self):
+        return self._stack("concentration")
+
+
+def is_layer_source(values):
+    """
+    True for data that is written one layer at a time instead of as an
+    array: objects with a shape (nlayers, ncells) and a layer(index) method
+    that returns the dense layer, like SparseGroupedCounts
+    """
+    return hasattr(values, "layer") and hasattr(values, "shape")
+
+
+def _index_key(index):
+    """Hashable key of an index (slices are not hashable)"""
+    if (isinstance(index, slice)):
+        return ("slice", index.start, index.stop, index.step)
+    if (np.ndim(index) > 0):
+        return tuple(np.ravel(index).tolist())
+    return index
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for reading, binning and writing.
+Every benchmark runs in a fresh process so that its peak RSS is measured
+on its own. Results are written as JSON.
+
+Usage:
+    python tests/benchmark/benchmark.py --ntime 200 --nparticles 100000 -o bench.json
+    python tests/benchmark/benchmark.py --benchmarks process --sort id --process-options="--sparse"
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shlex
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SORTS = ["all", "id", "state"]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.**2 if sys.platform == "darwin" else rss / 1024.
+
+
+def bench_read(particles, topo, resolution, chunk_size, sort):
+    from src.ppp_particle_file import ParticleFile
+    particle_file = ParticleFile(particles)
+    t0 = time.perf_counter()
+    for chunk in particle_file.iter_chunks(chunk_size):
+        chunk.lon, chunk.lat, chunk.state
+    return time.perf_counter() - t0, particle_file.ntime * particle_file.nparticles
+
+
+def bench_bin(particles, topo, resolution, chunk_size, sort):
+    from src.ppp_particle_file import ParticleFile
+    from src.ppp_grid import HorizontalGrid
+    particle_file = ParticleFile(particles)
+    grid = HorizontalGrid(topo, resolution)
+    # Data is read before timing, only binning is measured
+    chunks = list(particle_file.iter_chunks(chunk_size))
+    for chunk in chunks:
+        chunk.lon, chunk.lat, chunk.state
+    totals = {sort: grid.new_counter(particle_file, sort)}
+    t0 = time.perf_counter()
+    for chunk in chunks:
+        grid.count_chunk(chunk, totals)
+    return time.perf_counter() - t0, particle_file.ntime * particle_file.nparticles
+
+
+def bench_count(particles, topo, resolution, chunk_size, sort):
+    from src.ppp_particle_file import ParticleFile
+    from src.ppp_grid import HorizontalGrid
+    particle_file = ParticleFile(particles)
+    grid = HorizontalGrid(topo, resolution)
+    t0 = time.perf_counter()
+    grid.get_all_counts(particle_file, [sort], chunk_size)
+    return time.perf_counter() - t0, particle_file.ntime * particle_file.nparticles
+
+
+def _bench_write(particles, topo, resolution, chunk_size, sort, compact):
+    from src.ppp_particle_file import ParticleFile
+    from src.ppp_grid import HorizontalGrid
+    from src.ppp_result_file import ResultsFile
+    from src.ppp_quantity import Concentration, Counts
+    particle_file = ParticleFile(particles)
+    grid = HorizontalGrid(topo, resolution)
+    c, names = grid.get_counts(particle_file, sort, chunk_size)
+    counts = {"counts": c, "name_dict": names}
+    out = os.path.join(os.path.dirname(particles), f"results_{sort}.nc")
+    t0 = time.perf_counter()
+    result_file = ResultsFile(out, particles)
+    result_file.initialize(grid, groups=[sort], compact=compact)
+    result_file.append(Counts(grid).run(counts), sort)
+    result_file.append(Concentration(grid).run(counts), sort)
+    result_file.write()
+    return time.perf_counter() - t0, particle_file.ntime * particle_file.nparticles
+
+
+def bench_write(*args):
+    return _bench_write(*args, compact=False)
+
+
+def bench_write_compact(*args):
+    return _bench_write(*args, compact=True)
+
+
+def bench_startup(particles, topo, resolution, chunk_size, sort, nruns=10):
+    """Mean time of "ppp -h" (interpreter start, imports and argument parsing)"""
+    import subprocess
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+    t0 = time.perf_counter()
+    for irun in range(nruns):
+        subprocess.run([sys.executable, "-m", "src.main", "-h"], cwd=root,
+                       stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - t0) / nruns, 0
+
+
+def bench_process(particles, topo, resolution, chunk_size, sort, options=()):
+    """Whole process subcommand (counting, quantities and writing) with extra options"""
+    from src.main import main
+    from src.ppp_particle_file import ParticleFile
+    out = os.path.join(os.path.dirname(particles), f"process_{sort}.nc")
+    argv = ["ppp", "process", "-O", "-s", particles, "--topo", topo,
+            "-o", out, "--sort", sort] + list(options)
+    if (resolution is not None):
+        argv += ["-dx", str(resolution)]
+    if (chunk_size is not None):
+        argv += ["--chunk-size", str(chunk_size)]
+    sys.argv = argv
+    t0 = time.perf_counter()
+    main()
+    wall_time = time.perf_counter() - t0
+    particle_file = ParticleFile(particles)
+    return wall_time, particle_file.ntime * particle_file.nparticles
+
+
+BENCHMARKS = {"startup": bench_startup,
+              "read": bench_read,
+              "bin": bench_bin,
+              "count": bench_count,
+              "write": bench_write,
+              "write_compact": bench_write_compact,
+              "process": bench_process}
+
+
+def _run(name, *args, options=()):
+    # Keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        if (name == "process"):
+            wall_time, npositions = BENCHMARKS[name](*args, options=options)
+        else:
+            wall_time, npositions = BENCHMARKS[name](*args)
+    return wall_time, npositions, _peak_rss_mb()
+
+
+def run_benchmark(name, particles, topo, resolution, chunk_size, sort, options=()):
+    """Run a benchmark in a new process and return its measurements"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        wall_time, npositions, peak_rss = pool.submit(
+            _run, name, particles, topo, resolution, chunk_size, sort, options=options).result()
+    return {"benchmark": name,
+            "sort": sort,
+            "wall_time_s": wall_time,
+            "positions": npositions,
+            "positions_per_s": npositions / wall_time if (npositions and wall_time > 0) else None,
+            "peak_rss_mb": peak_rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ntime", type=int, default=100)
+    parser.add_argument("--nparticles", type=int, default=10000)
+    parser.add_argument("--nids", type=int, default=20)
+    parser.add_argument("--nlon", type=int, default=200)
+    parser.add_argument("--nlat", type=int, default=120)
+    parser.add_argument("-dx", "--resolution", type=float, default=None)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--benchmarks", nargs="*", choices=list(BENCHMARKS.keys()),
+                        default=list(BENCHMARKS.keys()))
+    parser.add_argument("--sort", nargs="*", choices=SORTS, default=SORTS)
+    parser.add_argument("--process-options", type=str, default="",
+                        help="Extra options of the process benchmark, e.g. \"--sparse --bandwidth 0\"")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of runs per benchmark")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Directory for the synthetic files (default: temporary)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="JSON output file (default: stdout)")
+    args = parser.parse_args()
+
+    from synthetic_data import write_particle_file, write_topo_file
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+        particles = os.path.join(workdir, "particles.nc")
+        topo = os.path.join(workdir, "topo.nc")
+        if (not os.path.exists(particles)):
+            write_particle_file(particles, args.ntime,
+                                args.nparticles, args.nids)
+        if (not os.path.exists(topo)):
+            write_topo_file(topo, args.nlon, args.nlat)
+
+        results = []
+        for name in args.benchmarks:
+            # Startup and reading do not depend on the sort type
+            sorts = ["all"] if name in ("startup", "read") else args.sort
+            for sort in sorts:
+                for irun in range(args.repeat):
+                    result = run_benchmark(
+                        name, particles, topo, args.resolution, args.chunk_size, sort,
+                        shlex.split(args.process_options))
+                    result["run"] = irun
+                    results.append(result)
+                    print(f"{name:>14s} {sort:>6s}: {result['wall_time_s']:8.3f} s, "
+                          f"{result['positions_per_s'] or 0:12.4g} positions/s, "
+                          f"{result['peak_rss_mb']:8.1f} MB", file=sys.stderr)
+
+    report = {"metadata": {"ntime": args.ntime,
+                           "nparticles": args.nparticles,
+                           "nids": args.nids,
+                           "nlon": args.nlon,
+                           "nlat": args.nlat,
+                           "resolution": args.resolution,
+                           "chunk_size": args.chunk_size,
+                           "process_options": args.process_options,
+                           "python": platform.python_version(),
+                           "platform": platform.platform(),
+                           "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    if (args.output is None):
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
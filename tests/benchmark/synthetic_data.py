@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Synthetic particle and topography files for benchmarks.
+The files follow the layout of the particle tracking model output:
+(time, particle) lon/lat/depth/state, per-particle id and fill values
+before release and after the particle is removed.
+"""
+
+import argparse
+import numpy as np
+from netCDF4 import Dataset
+
+LON_RANGE = (20., 30.)
+LAT_RANGE = (58., 61.)
+
+
+def write_topo_file(filename, nlon=200, nlat=120, lon_range=LON_RANGE, lat_range=LAT_RANGE):
+    """Write a regular lon/lat grid with a bathymetry that deepens to the east"""
+    lon = np.linspace(*lon_range, nlon)
+    lat = np.linspace(*lat_range, nlat)
+    with Dataset(filename, "w", format="NETCDF4") as f:
+        f.createDimension("lon", nlon)
+        f.createDimension("lat", nlat)
+        f.createVariable("lon", "float64", ("lon",))[:] = lon
+        f.createVariable("lat", "float64", ("lat",))[:] = lat
+        # Land (negative depth) along the western edge
+        depth = (np.linspace(-20., 100., nlon)[np.newaxis, :]
+                 + 10.*np.sin(np.linspace(0., np.pi, nlat))[:, np.newaxis])
+        f.createVariable("bathymetry", "float64", ("lat", "lon"))[:] = depth
+
+
+def write_particle_file(filename, ntime=100, nparticles=10000, nids=20, nstates=4,
+                        lon_range=LON_RANGE, lat_range=LAT_RANGE, seed=0):
+    """
+    Write a particle file with random walk trajectories.
+    Particles are released over the first third of the run and removed
+    at random times, inactive positions are fill values.
+    """
+    rng = np.random.default_rng(seed)
+    release = rng.integers(0, max(ntime//3, 1), nparticles)
+    removal = rng.integers(ntime//2, ntime + ntime//4 + 1, nparticles)
+    lon0 = rng.uniform(*lon_range, nparticles)
+    lat0 = rng.uniform(*lat_range, nparticles)
+    step = 0.01
+
+    with Dataset(filename, "w", format="NETCDF4") as f:
+        f.createDimension("time", None)
+        f.createDimension("particle", nparticles)
+        time = f.createVariable("time", "float64", ("time",))
+        time.units = "seconds since 2000-01-01 00:00:00"
+        time[:] = np.arange(ntime) * 3600.
+        ids = f.createVariable("id", "float64", ("particle",))
+        ids[:] = rng.integers(1, nids + 1, nparticles)
+        variables = {vname: f.createVariable(vname, dtype, ("time", "particle"))
+                     for vname, dtype in [("lon", "float64"), ("lat", "float64"),
+                                          ("depth", "float64"), ("state", "int32")]}
+        # Written one time step at a time so large files fit in memory
+        lon = lon0.copy()
+        lat = lat0.copy()
+        for itime in range(ntime):
+            lon = np.clip(lon + step*rng.standard_normal(nparticles), *lon_range)
+            lat = np.clip(lat + step*rng.standard_normal(nparticles), *lat_range)
+            inactive = (itime < release) | (itime > removal)
+            for vname, values in [("lon", lon), ("lat", lat),
+                                  ("depth", rng.uniform(0., 50., nparticles)),
+                                  ("state", rng.integers(0, nstates, nparticles))]:
+                variables[vname][itime, :] = np.ma.masked_array(values, inactive)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--particles", help="Particle file", type=str, default="particles.nc")
+    parser.add_argument("--topo", help="Topography file", type=str, default="topo.nc")
+    parser.add_argument("--ntime", type=int, default=100)
+    parser.add_argument("--nparticles", type=int, default=10000)
+    parser.add_argument("--nids", type=int, default=20)
+    parser.add_argument("--nlon", type=int, default=200)
+    parser.add_argument("--nlat", type=int, default=120)
+    args = parser.parse_args()
+    write_particle_file(args.particles, args.ntime, args.nparticles, args.nids)
+    write_topo_file(args.topo, args.nlon, args.nlat)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,23 @@ function check_process_success {
     fi
     print_separator
 }
+# Every counts group of the second results file is identical to the first
+function check_same_counts {
+    python -c "
+import sys
+import numpy as np
+from src.ppp_result_file import ResultsFile
+a, b = ResultsFile(sys.argv[1], None), ResultsFile(sys.argv[2], None)
+a.read()
+b.read()
+groups = [group for group, qname in b.quantities if qname == 'counts']
+same = [np.array_equal(a.labels(group), b.labels(group))
+        and np.array_equal(a.get(group, 'counts'), b.get(group, 'counts'))
+        for group in groups]
+sys.exit(0 if groups and all(same) else 1)
+" "$1" "$2"
+    check_process_success
+}
 # ------------------------------------------------------------------
 # Basic help test
 ppp -h
@@ -31,4 +48,80 @@ check_process_success
 ppp process -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc
 check_process_success
 ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc
-check_process_success
\ No newline at end of file
+check_process_success
+# Counts of all sort types in one pass are identical to a single sort type
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./reference.nc --sort all id state
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort id
+check_same_counts ./reference.nc ./output.nc
+# Chunked and parallel processing, counts are identical to the one-pass counts
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --chunk-size 10 --workers 2
+check_same_counts ./reference.nc ./output.nc
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --chunk-size 3
+check_same_counts ./reference.nc ./output.nc
+# Time series output
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --time-window daily
+check_process_success
+# Compact (compressed, single variable) output
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --compact
+check_process_success
+# Vertical profile and 3-D volume grids
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --grid profile -dz 5
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --grid profile -dz 5 --lat-band 59.0 59.5
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --grid volume -dz 5
+check_process_success
+# Ensemble of particle files (glob), one layer per member, incremental update
+ppp process -O -s "./data/*particles*.nc" --topo ./data/topo.nc -o ./output.nc --sort all member
+check_process_success
+ppp process -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all member --update
+check_process_success
+# Add only new time steps to an existing results file
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc
+check_process_success
+ppp process -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --update
+check_process_success
+# Sparse connectivity matrix from the release positions
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --connectivity --last
+check_process_success
+# Sparse counts in memory and in the results file are identical to the dense counts
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --sparse
+check_same_counts ./reference.nc ./output.nc
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --sparse-file --chunk-size 4
+check_same_counts ./reference.nc ./output.nc
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc -dx 500 --sort all id --sparse-file
+check_process_success
+# Stage timing report
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --profile ./profile.json --cprofile ./profile.prof
+check_process_success
+# Plots of a results file
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc
+check_process_success
+ppp plot -s ./output.nc -o ./plot.png
+check_process_success
+ppp plot -s ./output.nc -o ./plot.png --group id --quantity counts --log --workers 2
+check_process_success
+# Kernel density concentration with the default and a given bandwidth
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id
+check_process_success
+ppp plot -s ./output.nc -o ./plot.png --quantity smoothed_concentration
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc -dx 500 --bandwidth 2000
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --grid volume --sort all id --sparse --bandwidth 2000
+check_process_success
+# Residence time, particle age and arrival time
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --time-stats --workers 2
+check_process_success
+# Counts cache: the second run reuses the counts of the first one
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id --cache-dir ./cache
+check_process_success
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --cache-dir ./cache --cache-size 100
+check_process_success
+# Check the inputs only
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --dry-run
+check_process_success
+# Read the next blocks in the background while counting
+ppp process -O -s ./data/particles.nc --topo ./data/topo.nc -o ./output.nc --sort all id state --chunk-size 5 --prefetch 2 --workers 2
+check_same_counts ./reference.nc ./output.nc
@@ -0,0 +1,52 @@
+#!/bin/bash
+#-----------
+# Purpose: Guard the startup time of the command line interface.
+# Help and argument errors must not import numpy, netCDF4 or matplotlib
+# (they are imported by the subcommands), and "ppp -h" must stay fast.
+
+function print_separator {
+    echo "------------------------------------------------------------"
+}
+
+Red='\033[0;31m'
+Green='\033[0;32m'
+NC='\033[0m'
+function check_process_success {
+    err=$?
+    if [ $err -eq 0 ]; then
+        echo -e "${Green}Process success${NC}"
+    else
+        echo -e "${Red}Process failed:${NC} $err"
+    fi
+    print_separator
+}
+
+# Number of calls and limit of the mean time of a call (seconds)
+NRUNS=${NRUNS:-20}
+LIMIT=${LIMIT:-0.15}
+
+# Heavy modules are not imported with the CLI
+python -c "
+import sys
+import src.main
+heavy = [name for name in ('numpy', 'netCDF4', 'matplotlib') if name in sys.modules]
+print('Heavy modules imported at startup:', heavy if heavy else 'none')
+sys.exit(1 if heavy else 0)
+"
+check_process_success
+
+# Mean time of ppp -h
+python -c "
+import subprocess, sys, time
+t0 = time.perf_counter()
+for i in range($NRUNS):
+    subprocess.run(['ppp', '-h'], stdout=subprocess.DEVNULL, check=True)
+mean = (time.perf_counter() - t0) / $NRUNS
+print(f'ppp -h: {mean*1000:.1f} ms per call (limit {$LIMIT*1000:.0f} ms)')
+sys.exit(1 if mean > $LIMIT else 0)
+"
+check_process_success
+
+# Argument errors are as fast, the command must fail
+! ppp process
+check_process_success